@@ -1,5 +1,16 @@
-from .env_logging import init_env_logging
-from .utils import split_dataset
+import importlib
 
+# Submodules are imported on first attribute access so that importing ai_tools stays cheap.
+_exports = {
+    'init_env_logging': '.env_logging',
+    'split_dataset': '.utils',
+}
 
-__all__ = ['init_env_logging', 'split_dataset']
\ No newline at end of file
+
+def __getattr__(name):
+    if name in _exports:
+        return getattr(importlib.import_module(_exports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ['init_env_logging', 'split_dataset']
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from amirbot.ai_tools import record_log
+
+logger = logging.getLogger(__name__)
+
+# Request files use the OpenAI Batch API input format, so they can be uploaded as they are
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+
+
+def write_requests(path, requests):
+    """
+    Writes a request file, one {"custom_id", "method", "url", "body"} line per (key, body) pair.
+    The file is moved into place when complete.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        for key, body in requests:
+            f.write(json.dumps({"custom_id": key, "method": "POST", "url": CHAT_COMPLETIONS_URL, "body": body}) + "\n")
+    os.replace(tmp_path, path)
+
+
+def read_requests(path):
+    with open(path) as f:
+        for line in f:
+            request = json.loads(line)
+            yield request["custom_id"], request["body"]
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class LocalBatchExecutor:
+    """
+    Answers a request file in-process with many concurrent calls, a stand-in for a batch API that
+    also suits local and fake LMs. Responses are appended to a record log as they arrive, so an
+    interrupted run only redoes what is missing.
+    """
+
+    def __init__(self, send, concurrency=64):
+        """
+        Parameters:
+        - send: send(key, body) returning the chat completion response as a dict.
+        """
+        self.send = send
+        self.concurrency = concurrency
+
+    def run(self, requests_path, results_path):
+        done = record_log.completed_keys(results_path)
+        pending = [(key, body) for key, body in read_requests(requests_path) if key not in done]
+        failed = 0
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor, record_log.RecordLog(results_path) as results:
+            futures = {executor.submit(self.send, key, body): key for key, body in pending}
+            for future in as_completed(futures):
+                try:
+                    results.append(futures[future], future.result())
+                except Exception:
+                    failed += 1
+                    logger.exception(f"Batch request {futures[future]} failed")
+
+        logger.info(f"Answered {len(pending) - failed} of {len(pending)} requests from {requests_path}")
+
+
+class OpenAIBatchExecutor:
+    """
+    Runs a request file through the OpenAI Batch API: upload, create the batch, poll, download.
+
+    The batch id is kept in <requests>.batch.json, so a restarted job resumes polling the batch it
+    already submitted instead of paying for it twice.
+    """
+
+    def __init__(self, client=None, poll_interval=60.0, completion_window="24h"):
+        self.client = client
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+
+    def _client(self):
+        if self.client is None:
+            import openai
+            self.client = openai.OpenAI()
+        return self.client
+
+    def _submit(self, requests_path, state_path):
+        client = self._client()
+        with open(requests_path, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+
+        # Through the raw endpoint, older openai clients have no batches resource
+        batch = client.post("/batches", cast_to=object, body={"input_file_id": input_file.id, "endpoint": CHAT_COMPLETIONS_URL, "completion_window": self.completion_window})
+
+        state = {"batch_id": batch["id"], "requests_hash": file_hash(requests_path)}
+        with open(state_path, "w") as f:
+            json.dump(state, f)
+        logger.info(f"Submitted {requests_path} as batch {batch['id']}")
+        return batch["id"]
+
+    def run(self, requests_path, results_path):
+        client = self._client()
+        state_path = f"{requests_path}.batch.json"
+
+        batch_id = None
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            if state["requests_hash"] == file_hash(requests_path):
+                batch_id = state["batch_id"]
+                logger.info(f"Resuming batch {batch_id} for {requests_path}")
+        if batch_id is None:
+            batch_id = self._submit(requests_path, state_path)
+
+        while True:
+            batch = client.get(f"/batches/{batch_id}", cast_to=object)
+            if batch["status"] in ("completed", "failed", "expired", "cancelled"):
+                break
+            counts = batch.get("request_counts") or {}
+            logger.info(f"Batch {batch_id} is {batch['status']}: {counts.get('completed', 0)}/{counts.get('total', '?')} done")
+            time.sleep(self.poll_interval)
+
+        # Expired and cancelled batches still return what they finished
+        done = record_log.completed_keys(results_path)
+        failed = 0
+        with record_log.RecordLog(results_path) as results:
+            if batch.get("output_file_id"):
+                for line in client.files.content(batch["output_file_id"]).text.splitlines():
+                    output = json.loads(line)
+                    response = output.get("response") or {}
+                    if response.get("status_code") != 200:
+                        failed += 1
+                    elif output["custom_id"] not in done:
+                        results.append(output["custom_id"], response["body"])
+
+        if batch.get("error_file_id"):
+            failed += len(client.files.content(batch["error_file_id"]).text.splitlines())
+
+        logger.info(f"Batch {batch_id} {batch['status']}, {failed} requests failed")
+        if batch["status"] == "failed":
+            raise RuntimeError(f"Batch {batch_id} for {requests_path} failed: {batch.get('errors')}")
@@ -0,0 +1,121 @@
+import itertools
+import json
+import logging
+import os
+import numpy as np
+
+from amirbot.ai_tools.vector_index import hashed_counts, idf_weights, tfidf_vectors
+
+logger = logging.getLogger(__name__)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+class EmailBucketer:
+    """
+    Groups e-mails by type: hashed TF-IDF vectors clustered with MiniBatchKMeans.
+
+    fit() streams the texts twice in batches (document frequencies, then k-means partial_fit),
+    so the corpus never has to be in memory. predict() only needs the saved IDF weights and
+    centroids, so serving doesn't import sklearn.
+    """
+
+    def __init__(self, num_buckets=8, dims=4096, batch_size=256, seed=0):
+        self.num_buckets = num_buckets
+        self.dims = dims
+        self.batch_size = batch_size
+        self.seed = seed
+        self.idf = None
+        self.centroids = None
+
+    def fit(self, texts):
+        """
+        Parameters:
+        - texts: A list, or a callable returning a fresh iterator over the texts (e.g. re-reading a
+          JSONL file), since they are read twice.
+        """
+        from sklearn.cluster import MiniBatchKMeans
+
+        iterate = texts if callable(texts) else lambda: iter(texts)
+
+        document_frequency = np.zeros(self.dims, dtype=np.int64)
+        num_documents = 0
+        for batch in _batches(iterate(), self.batch_size):
+            document_frequency += np.count_nonzero(hashed_counts(batch, self.dims), axis=0)
+            num_documents += len(batch)
+
+        if num_documents < self.num_buckets:
+            raise ValueError(f"Need at least {self.num_buckets} texts to make {self.num_buckets} buckets, got {num_documents}")
+
+        self.idf = idf_weights(document_frequency, num_documents)
+
+        kmeans = MiniBatchKMeans(n_clusters=self.num_buckets, batch_size=self.batch_size, random_state=self.seed, n_init=3)
+        pending = []
+        for batch in _batches(iterate(), self.batch_size):
+            pending.extend(batch)
+            # partial_fit initializes the centroids from its first batch, which needs at least one row per cluster
+            if len(pending) >= max(self.num_buckets, self.batch_size):
+                kmeans.partial_fit(tfidf_vectors(pending, self.idf))
+                pending = []
+        if pending:
+            kmeans.partial_fit(tfidf_vectors(pending, self.idf))
+
+        self.centroids = kmeans.cluster_centers_.astype(np.float32)
+        logger.info(f"Fit {self.num_buckets} buckets over {num_documents} texts")
+        return self
+
+    def fit_labels(self, texts, labels):
+        """
+        Fits the buckets to texts already assigned to them: each centroid is the mean vector of its
+        bucket's texts. This routes one kind of text (e.g. notes) to buckets clustered on another
+        (e-mails). A bucket without texts keeps a zero centroid, which only wins for texts unlike
+        every other bucket.
+
+        Parameters:
+        - texts / labels: Lists of the texts and their bucket numbers.
+        """
+        document_frequency = np.zeros(self.dims, dtype=np.int64)
+        for batch in _batches(texts, self.batch_size):
+            document_frequency += np.count_nonzero(hashed_counts(batch, self.dims), axis=0)
+        self.idf = idf_weights(document_frequency, len(texts))
+
+        sums = np.zeros((self.num_buckets, self.dims), dtype=np.float64)
+        counts = np.zeros(self.num_buckets, dtype=np.int64)
+        for start in range(0, len(texts), self.batch_size):
+            vectors = tfidf_vectors(texts[start:start + self.batch_size], self.idf)
+            batch_labels = np.asarray(labels[start:start + self.batch_size])
+            np.add.at(sums, batch_labels, vectors)
+            counts += np.bincount(batch_labels, minlength=self.num_buckets)
+
+        self.centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+        logger.info(f"Fit {self.num_buckets} bucket routes over {len(texts)} texts, {int((counts == 0).sum())} buckets empty")
+        return self
+
+    def predict(self, texts):
+        """Index of the nearest centroid for each text."""
+        vectors = tfidf_vectors(list(texts), self.idf)
+        # argmin |x - c|^2 == argmin |c|^2 - 2 x.c, as one matrix product
+        distances = (self.centroids ** 2).sum(axis=1) - 2 * vectors @ self.centroids.T
+        return np.argmin(distances, axis=1)
+
+    def predict_one(self, text):
+        return int(self.predict([text])[0])
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "idf.npy"), self.idf)
+        np.save(os.path.join(path, "centroids.npy"), self.centroids)
+        with open(os.path.join(path, "bucketer.json"), "w") as f:
+            json.dump({"num_buckets": self.num_buckets, "dims": self.dims, "batch_size": self.batch_size, "seed": self.seed}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "bucketer.json")) as f:
+            bucketer = cls(**json.load(f))
+        bucketer.idf = np.load(os.path.join(path, "idf.npy"))
+        bucketer.centroids = np.load(os.path.join(path, "centroids.npy"))
+        return bucketer
@@ -0,0 +1,85 @@
+import itertools
+import json
+import os
+
+# Bumped when the layout of tables written here changes, readers refuse newer versions
+FORMAT_VERSION = 1
+_metadata_key = b"amirbot"
+
+
+def write_table(path, records, columns, batch_size=1024, metadata=None, types=None):
+    """
+    Streams records into a Parquet file, one column per field.
+
+    Parameters:
+    - records: Iterable of dicts, read batch_size at a time so it never has to fit in memory.
+    - columns: The fields to store, missing ones are written as nulls.
+    - types: Optional {column: pyarrow type}, columns not in it are strings.
+    - metadata: Optional JSON-serializable dict saved in the file footer.
+
+    Returns:
+    - The number of rows written. The file is written next to path and moved into place when
+      complete, so readers never see a partial table.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(column, (types or {}).get(column, pa.string())) for column in columns]).with_metadata({
+        _metadata_key: json.dumps({"version": FORMAT_VERSION, **(metadata or {})})
+    })
+
+    tmp_path = f"{path}.tmp"
+    num_rows = 0
+    records = iter(records)
+    with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+        while batch := list(itertools.islice(records, batch_size)):
+            writer.write_table(pa.Table.from_pydict({column: [record.get(column) for record in batch] for column in columns}, schema=schema))
+            num_rows += len(batch)
+
+    os.replace(tmp_path, path)
+    return num_rows
+
+
+class ColumnarReader:
+    """
+    Lazy reader of a table written by write_table.
+
+    The file is memory-mapped and decoded one row group batch at a time, only for the projected
+    columns, so iterating holds a single batch of rows in memory.
+    """
+
+    def __init__(self, path, columns=None, batch_size=1024):
+        """
+        Parameters:
+        - columns: Optional list of columns to read, all of them by default.
+        """
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.batch_size = batch_size
+        self._file = pq.ParquetFile(path, memory_map=True)
+
+        schema = self._file.schema_arrow
+        self.metadata = json.loads((schema.metadata or {}).get(_metadata_key, b"{}"))
+        if self.metadata.get("version", FORMAT_VERSION) > FORMAT_VERSION:
+            raise ValueError(f"{path} was written by a newer version (format {self.metadata['version']}, this reader supports {FORMAT_VERSION})")
+
+        missing = set(columns or []) - set(schema.names)
+        if missing:
+            raise KeyError(f"{path} has no columns {sorted(missing)}")
+        self.columns = list(columns or schema.names)
+
+    def __len__(self):
+        return self._file.metadata.num_rows
+
+    def __iter__(self):
+        for batch in self._file.iter_batches(batch_size=self.batch_size, columns=self.columns):
+            yield from batch.to_pylist()
+
+    def column(self, name):
+        """All values of one column as a list."""
+        return self._file.read(columns=[name]).column(name).to_pylist()
+
+    def table(self):
+        """The projected columns as one pyarrow Table, e.g. for vectorized filtering."""
+        return self._file.read(columns=self.columns)
@@ -0,0 +1,107 @@
+import re
+
+# Bumped whenever a change here alters cleaned output, so caches of it (the mailbox index) rebuild
+VERSION = 3
+
+# Everything from one of these lines down is a quoted reply or forwarded message, not the author's text
+_reply_header = re.compile(r"^\s*(On .{5,200} wrote:|-+ ?Original Message ?-+|-+ ?Forwarded message ?-+|Begin forwarded message:)\s*$", re.IGNORECASE)
+# Outlook-style quoted headers have no marker line, only a From: line followed by Sent/Date/To/...
+# lines. A From: line on its own is left alone, it can be part of the author's text.
+_from_header = re.compile(r"^\s*From: .+\s*$", re.IGNORECASE)
+_header_field = re.compile(r"^\s*(Sent|Date|To|Cc|Subject): .*$", re.IGNORECASE)
+# "-- " is the standard signature delimiter, "__" lines are common Outlook separators
+_delimiter = re.compile(r"^\s*(--|__+)\s*$")
+_mobile_footer = re.compile(r"^\s*(Sent from my \w+|Sent from (Mail|Outlook|Yahoo Mail|Gmail) for \w+|Sent from (Outlook|Gmail|Yahoo Mail)|Get Outlook for \w+|Sent via .+|Sent with .+)\.?\s*$", re.IGNORECASE)
+# A sign-off alone on its line, or followed by a comma and a name ("Thanks, Amir"), never by other
+# words, so headings like "Best practices" aren't one
+_sign_off = re.compile(r"^\s*(thanks|thanks again|thanks all|many thanks|thank you|thx|best|all the best|best regards|kind regards|warm regards|regards|cheers|sincerely|warmly|talk soon|speak soon|take care|yours)\s*([,.!]*|,\s*[A-Z][\w.-]*)\s*$", re.IGNORECASE)
+# "-Amir" as the last line, as long as it isn't the end of a bulleted list
+_dash_name = re.compile(r"^\s*[-~]\s?[A-Z][a-z]+\s*$")
+# Lines typical of a signature block: names, titles, phone numbers, urls, addresses
+_contact = re.compile(r"\+?\d[\d ().-]{6,}\d|https?://\S+|www\.\S+|[\w.+-]+@[\w.-]+\.\w+")
+_sentence = re.compile(r"[.!?:)]\s*$")
+_bullet = re.compile(r"^\s*([-*•]|\d+[.)])\s")
+
+# How many trailing lines a signature block may span after the sign-off
+MAX_SIGNATURE_LINES = 5
+
+
+def _is_header_block(lines, i):
+    # From: followed by at least one more header field before any other text
+    fields = [line for line in lines[i + 1:i + 4] if line.strip()]
+    return bool(fields) and _header_field.match(fields[0]) is not None
+
+
+def strip_quotes(body):
+    """Removes quoted (>) lines and everything from a reply header or forwarded-message marker down."""
+    all_lines = (body or "").split("\n")
+    lines = []
+    for i, line in enumerate(all_lines):
+        if _reply_header.match(line) or (_from_header.match(line) and _is_header_block(all_lines, i)):
+            break
+        if not line.lstrip().startswith(">"):
+            lines.append(line)
+    return "\n".join(lines).strip()
+
+
+def _is_signature_line(line):
+    # Contact details, or a short line that isn't a sentence (a name, title or company)
+    return bool(_contact.search(line) or _mobile_footer.match(line) or (len(line.split()) <= 6 and not _sentence.search(line)))
+
+
+def _is_signature_block(lines):
+    # A bulleted tail is content (a list under a heading), never a signature
+    return len(lines) <= MAX_SIGNATURE_LINES and not any(_bullet.match(line) for line in lines) and all(_is_signature_line(line) for line in lines)
+
+
+def strip_signature(body):
+    """
+    Removes the sign-off and signature block from the end of an e-mail.
+
+    Returns:
+    - (cleaned body, confidence in [0, 1] that the result is what a careful reader would produce)
+    """
+    lines = (body or "").rstrip().split("\n")
+
+    # Mobile footers are unambiguous, drop them wherever they trail
+    while lines and (_mobile_footer.match(lines[-1]) or not lines[-1].strip()):
+        lines.pop()
+
+    content = [i for i, line in enumerate(lines) if line.strip()]
+    if not content:
+        return "", 1.0
+
+    delimiters = [i for i in content if _delimiter.match(lines[i])]
+    if delimiters:
+        # Only the last delimiter, close to the end and followed by a signature block, marks the
+        # signature. Otherwise it separates sections of the e-mail and the LM should decide
+        i = delimiters[-1]
+        if i in content[-(MAX_SIGNATURE_LINES + 1):] and _is_signature_block([line for line in lines[i + 1:] if line.strip()]):
+            return "\n".join(lines[:i]).rstrip(), 1.0
+        return "\n".join(lines).rstrip(), 0.5
+
+    # Look for a sign-off among the last lines, closest to the body first
+    for i in content[-(MAX_SIGNATURE_LINES + 1):]:
+        dash_name = i == content[-1] and len(content) > 1 and _dash_name.match(lines[i]) and not lines[content[-2]].lstrip().startswith("-")
+        if _sign_off.match(lines[i]) or dash_name:
+            tail = [line for line in lines[i + 1:] if line.strip()]
+            if _is_signature_block(tail):
+                return "\n".join(lines[:i]).rstrip(), 1.0
+            # A sign-off followed by more than a signature, e.g. a P.S., a list or a long legal
+            # footer: keep everything and report low confidence so the caller falls back to the LM
+            return "\n".join(lines).rstrip(), 0.5
+
+    last = lines[content[-1]]
+    if len(content) == 1 or _sentence.search(last):
+        # Ends on a regular sentence (or is a one-liner), there is no signature to remove
+        return "\n".join(lines).rstrip(), 0.9
+    if len(last.split()) <= 3 and all(word[0].isupper() for word in last.split()):
+        # A bare name after the last paragraph
+        return "\n".join(lines[:content[-1]]).rstrip(), 0.8
+
+    return "\n".join(lines).rstrip(), 0.3
+
+
+def clean_email(body):
+    """strip_quotes then strip_signature, returns (cleaned body, confidence)."""
+    return strip_signature(strip_quotes(body))
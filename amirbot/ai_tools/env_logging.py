@@ -2,7 +2,6 @@ import dotenv
 import logging
 import logging.config
 import os
-from rich.logging import RichHandler
 
 
 def init_env_logging(env_path):
@@ -12,7 +11,11 @@ def init_env_logging(env_path):
     config_path = os.getenv('LOGGING_CONF_PATH')
 
     # Use the configuration file appropriate to the environment
-    logging.config.fileConfig(config_path)
+    if config_path:
+        logging.config.fileConfig(config_path)
+    else:
+        from rich.logging import RichHandler
+        logging.basicConfig(level=logging.INFO, handlers=[RichHandler()])
     logging.getLogger("httpx").setLevel(logging.WARNING)
     logging.getLogger("openai").setLevel(logging.DEBUG)
     logging.getLogger("httpcore.connection").setLevel(logging.DEBUG)
@@ -1,15 +1,5 @@
 import logging
 import os
-from langchain.embeddings import OpenAIEmbeddings, OllamaEmbeddings
-from langchain.llms.openai import OpenAI
-from langchain.chat_models import ChatOpenAI, ChatOllama
-from langchain.globals import set_llm_cache
-from langchain.indexes import SQLRecordManager, index
-from langchain.cache import SQLiteCache
-from langchain.vectorstores.pgvector import PGVector
-from langchain.cache import SQLiteCache
-from langchain.globals import set_llm_cache
-import httpx
 
 _vectordb = None
 _embedding = None
@@ -49,6 +39,11 @@ def init():
         logger.warning("LLM already initialized, skipping")
         return _llm
 
+    # langchain is slow to import, so only pay for it when the LLM is actually initialized
+    from langchain.embeddings import OpenAIEmbeddings
+    from langchain.chat_models import ChatOpenAI
+    import httpx
+
     _llm = ChatOpenAI(model_name=OPENAI_MODEL, temperature=OPENAI_TEMPERATURE)
     _embedding = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY, timeout=30)
     # _db = initialize_db(db_connection_string, record_manager_connection_string)
@@ -79,6 +74,9 @@ def initialize_db(db_connection_string, record_manager_connection_string, db_col
     if _db:
         raise Exception("DB already initialized")
 
+    from langchain.indexes import SQLRecordManager
+    from langchain.vectorstores.pgvector import PGVector
+
     _db = PGVector(
         embedding_function=get_embedding_fn(),
         collection_name=db_collection_name,
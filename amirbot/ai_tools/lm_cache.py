@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """
+    On-disk cache of LM responses backed by SQLite.
+
+    Entries are keyed by a caller supplied content hash (see dspy_lm.request_key). The database
+    runs in WAL mode with one connection per thread, so it can be shared by the thread pools in
+    the scripts and by several processes pointing at the same file.
+
+    Parameters:
+    - path: Location of the SQLite database.
+    - max_entries: Keep at most this many entries, evicting the least recently used first.
+    - max_bytes: Keep the stored responses under this many bytes, evicting the least recently used first.
+    - max_age: Drop entries created more than this many seconds ago.
+    """
+
+    EVICT_EVERY = 100
+
+    def __init__(self, path, max_entries=None, max_bytes=None, max_age=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                temperature REAL,
+                max_tokens INTEGER,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        conn.commit()
+        self.evict()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+
+        if row is not None and self.max_age is not None and row[1] < time.time() - self.max_age:
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if row is None:
+            return None
+
+        with conn:
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+
+        return json.loads(row[0])
+
+    def set(self, key, response, model=None, temperature=None, max_tokens=None):
+        data = json.dumps(response)
+        now = time.time()
+
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, model, temperature, max_tokens, data, len(data), now, now)
+            )
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.EVICT_EVERY == 0
+
+        if evict:
+            self.evict()
+
+    def evict(self):
+        conn = self._conn()
+        with conn:
+            if self.max_age is not None:
+                conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+
+            if self.max_entries is not None:
+                conn.execute("""
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                    )
+                """, (self.max_entries,))
+
+            if self.max_bytes is not None:
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_bytes:
+                    rows = conn.execute("SELECT key, size FROM responses ORDER BY accessed ASC").fetchall()
+                    evicted = []
+                    for key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        evicted.append((key,))
+                        total -= size
+                    conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        conn = self._conn()
+        entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+        with self._lock:
+            hits, misses = self.hits, self.misses
+
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def log_stats(self):
+        logger = logging.getLogger(__name__)
+        stats = self.stats()
+        logger.info(f"LM cache {self.path}: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), {stats['entries']} entries, {stats['bytes']} bytes")
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+# USD per 1K (prompt, completion) tokens, matched by longest model name prefix. Override or extend
+# with LM_PRICES='{"model-name": [prompt, completion]}'.
+MODEL_PRICES = {
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4-1106": (0.01, 0.03),
+    "gpt-4-0125": (0.01, 0.03),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo-instruct": (0.0015, 0.002),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300)
+PROMPT_TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+
+def model_price(model):
+    prices = dict(MODEL_PRICES)
+    if os.getenv("LM_PRICES"):
+        prices.update({k: tuple(v) for k, v in json.loads(os.getenv("LM_PRICES")).items()})
+
+    matches = [prefix for prefix in prices if model and model.startswith(prefix)]
+    if not matches:
+        return (0.0, 0.0)
+    return prices[max(matches, key=len)]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+
+class _Series:
+    MAX_SAMPLES = 10000
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.latency_sum = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.samples = []
+        self.prompt_token_buckets = [0] * len(PROMPT_TOKEN_BUCKETS)
+        self.prompt_token_samples = []
+        self.first_token_samples = []
+        self.models = set()
+        self.counters = {}
+
+    def _sample(self, samples, value):
+        # Reservoir sample so percentiles stay cheap on long runs
+        if len(samples) < self.MAX_SAMPLES:
+            samples.append(value)
+        else:
+            idx = random.randrange(self.calls)
+            if idx < self.MAX_SAMPLES:
+                samples[idx] = value
+
+    def observe_latency(self, latency):
+        self.latency_sum += latency
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+        self._sample(self.samples, latency)
+
+    def observe_prompt_tokens(self, prompt_tokens):
+        for i, bound in enumerate(PROMPT_TOKEN_BUCKETS):
+            if prompt_tokens <= bound:
+                self.prompt_token_buckets[i] += 1
+        self._sample(self.prompt_token_samples, prompt_tokens)
+
+
+class MetricsRegistry:
+    """
+    Thread-safe per-predictor call counts, latency histograms, token usage and estimated cost.
+    Series are keyed by the label of the dspy predictor that issued the call (see dspy_lm).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._dumper = None
+
+    def _get(self, name):
+        series = self._series.get(name)
+        if series is None:
+            series = self._series[name] = _Series()
+        return series
+
+    def record(self, name, model, latency, prompt_tokens=0, completion_tokens=0, error=False):
+        prompt_price, completion_price = model_price(model)
+
+        with self._lock:
+            series = self._get(name)
+            series.calls += 1
+            series.errors += 1 if error else 0
+            series.prompt_tokens += prompt_tokens
+            series.completion_tokens += completion_tokens
+            series.cost += prompt_tokens / 1000 * prompt_price + completion_tokens / 1000 * completion_price
+            if model:
+                series.models.add(model)
+            series.observe_latency(latency)
+            if not error:
+                series.observe_prompt_tokens(prompt_tokens)
+
+    def record_first_token(self, name, latency):
+        """Time from sending a streamed request to its first piece of text."""
+        with self._lock:
+            series = self._get(name)
+            series._sample(series.first_token_samples, latency)
+
+    def increment(self, name, counter, amount=1):
+        with self._lock:
+            series = self._get(name)
+            series.counters[counter] = series.counters.get(counter, 0) + amount
+
+    def latency_percentile(self, name, q, min_samples=20):
+        with self._lock:
+            series = self._series.get(name)
+            if series is None or len(series.samples) < min_samples:
+                return None
+            samples = sorted(series.samples)
+        return percentile(samples, q)
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for name, series in sorted(self._series.items()):
+                samples = sorted(series.samples)
+                prompt_sizes = sorted(series.prompt_token_samples)
+                first_tokens = sorted(series.first_token_samples)
+                result[name] = {
+                    "models": sorted(series.models),
+                    "calls": series.calls,
+                    "errors": series.errors,
+                    "latency_seconds": {
+                        "mean": series.latency_sum / series.calls if series.calls else None,
+                        "p50": percentile(samples, 0.50),
+                        "p95": percentile(samples, 0.95),
+                        "p99": percentile(samples, 0.99),
+                        "max": samples[-1] if samples else None,
+                        "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS], series.buckets)),
+                    },
+                    "prompt_tokens": series.prompt_tokens,
+                    "prompt_tokens_per_call": {
+                        "p50": percentile(prompt_sizes, 0.50),
+                        "p95": percentile(prompt_sizes, 0.95),
+                        "max": prompt_sizes[-1] if prompt_sizes else None,
+                        "buckets": dict(zip([str(b) for b in PROMPT_TOKEN_BUCKETS], series.prompt_token_buckets)),
+                    },
+                    "completion_tokens": series.completion_tokens,
+                    "time_to_first_token_seconds": {
+                        "streamed": len(first_tokens),
+                        "p50": percentile(first_tokens, 0.50),
+                        "p95": percentile(first_tokens, 0.95),
+                    },
+                    "cost_usd": round(series.cost, 6),
+                    **series.counters,
+                }
+            return result
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, values):
+            lines.append(f"# HELP amirbot_lm_{name} {help_text}")
+            lines.append(f"# TYPE amirbot_lm_{name} {kind}")
+            lines.extend(values)
+
+        metric("calls_total", "counter", "LM calls per predictor.", [f'amirbot_lm_calls_total{{predictor="{p}"}} {s["calls"]}' for p, s in snapshot.items()])
+        metric("errors_total", "counter", "Failed LM calls per predictor.", [f'amirbot_lm_errors_total{{predictor="{p}"}} {s["errors"]}' for p, s in snapshot.items()])
+        metric("prompt_tokens_total", "counter", "Prompt tokens per predictor.", [f'amirbot_lm_prompt_tokens_total{{predictor="{p}"}} {s["prompt_tokens"]}' for p, s in snapshot.items()])
+        metric("completion_tokens_total", "counter", "Completion tokens per predictor.", [f'amirbot_lm_completion_tokens_total{{predictor="{p}"}} {s["completion_tokens"]}' for p, s in snapshot.items()])
+        metric("cost_usd_total", "counter", "Estimated spend per predictor.", [f'amirbot_lm_cost_usd_total{{predictor="{p}"}} {s["cost_usd"]}' for p, s in snapshot.items()])
+
+        metric("hedged_total", "counter", "LM calls that got a hedged duplicate request per predictor.", [f'amirbot_lm_hedged_total{{predictor="{p}"}} {s.get("hedged", 0)}' for p, s in snapshot.items()])
+        metric("hedge_won_total", "counter", "Hedged calls answered first by the duplicate per predictor.", [f'amirbot_lm_hedge_won_total{{predictor="{p}"}} {s.get("hedge_won", 0)}' for p, s in snapshot.items()])
+        metric("deadline_exceeded_total", "counter", "LM calls that failed their deadline per predictor.", [f'amirbot_lm_deadline_exceeded_total{{predictor="{p}"}} {s.get("deadline_exceeded", 0)}' for p, s in snapshot.items()])
+
+        histogram = []
+        for p, s in snapshot.items():
+            latency = s["latency_seconds"]
+            for bound, count in latency["buckets"].items():
+                histogram.append(f'amirbot_lm_latency_seconds_bucket{{predictor="{p}",le="{bound}"}} {count}')
+            histogram.append(f'amirbot_lm_latency_seconds_bucket{{predictor="{p}",le="+Inf"}} {s["calls"]}')
+            histogram.append(f'amirbot_lm_latency_seconds_sum{{predictor="{p}"}} {(latency["mean"] or 0) * s["calls"]}')
+            histogram.append(f'amirbot_lm_latency_seconds_count{{predictor="{p}"}} {s["calls"]}')
+        metric("latency_seconds", "histogram", "LM call latency per predictor.", histogram)
+
+        histogram = []
+        for p, s in snapshot.items():
+            sizes = s["prompt_tokens_per_call"]
+            for bound, count in sizes["buckets"].items():
+                histogram.append(f'amirbot_lm_prompt_tokens_bucket{{predictor="{p}",le="{bound}"}} {count}')
+            histogram.append(f'amirbot_lm_prompt_tokens_bucket{{predictor="{p}",le="+Inf"}} {s["calls"] - s["errors"]}')
+            histogram.append(f'amirbot_lm_prompt_tokens_sum{{predictor="{p}"}} {s["prompt_tokens"]}')
+            histogram.append(f'amirbot_lm_prompt_tokens_count{{predictor="{p}"}} {s["calls"] - s["errors"]}')
+        metric("prompt_tokens", "histogram", "Prompt size per successful LM call per predictor.", histogram)
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Writes Prometheus text if path ends in .prom, JSON otherwise."""
+        data = self.to_prometheus() if path.endswith(".prom") else json.dumps(self.snapshot(), indent=2)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def start_periodic_dump(self, path, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except Exception:
+                    logging.getLogger(__name__).exception(f"Failed to dump LM metrics to {path}")
+
+        self._dumper = threading.Thread(target=run, name="lm-metrics-dump", daemon=True)
+        self._dumper.start()
+
+    def log_summary(self):
+        logger = logging.getLogger(__name__)
+        for name, s in self.snapshot().items():
+            latency = s["latency_seconds"]
+            sizes = s["prompt_tokens_per_call"]
+            logger.info(f"LM {name}: {s['calls']} calls, p50 {latency['p50'] or 0:.2f}s p95 {latency['p95'] or 0:.2f}s p99 {latency['p99'] or 0:.2f}s, {s['prompt_tokens']} prompt + {s['completion_tokens']} completion tokens (prompt p50 {sizes['p50'] or 0} p95 {sizes['p95'] or 0}), ${s['cost_usd']:.4f}"
+                        + (f", first token p50 {s['time_to_first_token_seconds']['p50']:.2f}s p95 {s['time_to_first_token_seconds']['p95']:.2f}s" if s["time_to_first_token_seconds"]["streamed"] else "")
+                        + (f", {s.get('hedged', 0)} hedged ({s.get('hedge_won', 0)} won), {s.get('deadline_exceeded', 0)} past deadline" if s.get("hedged") or s.get("deadline_exceeded") else ""))
@@ -0,0 +1,236 @@
+import contextlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+
+from amirbot.ai_tools import columnar, email_cleaning
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the index layout changes, stamped in meta.json along with email_cleaning.VERSION so
+# open() rebuilds indexes written by older code
+FORMAT_VERSION = 1
+
+INDEX_COLUMNS = ["subject", "from", "to", "date", "is_reply", "is_forward", "chars", "words", "offset", "length", "source_offset", "source_length"]
+
+
+def _json_loads():
+    # ujson parses mailbox lines several times faster, the stdlib parser is the fallback
+    try:
+        import ujson
+        return ujson.loads
+    except ImportError:
+        return json.loads
+
+
+def index_path(mailbox_path):
+    # mailbox.jsonl -> mailbox.index/
+    return os.path.splitext(mailbox_path)[0] + ".index"
+
+
+def _source_stamp(mailbox_path):
+    stat = os.stat(mailbox_path)
+    return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns, "format_version": FORMAT_VERSION, "cleaner_version": email_cleaning.VERSION}
+
+
+def _is_current(mailbox_path, path):
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return False
+    return all(meta.get(name) == value for name, value in _source_stamp(mailbox_path).items())
+
+
+@contextlib.contextmanager
+def _build_lock(path):
+    # Sharded workers open the same mailbox at once, only one of them builds the index
+    try:
+        import fcntl
+    except ImportError:
+        # No flock (Windows): concurrent builds still can't corrupt each other, they only repeat work
+        yield
+        return
+
+    with open(os.path.join(path, ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class MailboxIndex:
+    """
+    A mailbox JSONL parsed once: quote-stripped bodies concatenated in bodies.bin, and a Parquet
+    index of subject/from/to/date, reply and forward flags, sizes and byte offsets.
+
+    Subsets are selected on the index alone and bodies are read from a memory map, so later runs
+    never rescan or reparse the mailbox. open() rebuilds the index when the mailbox or the cleaning
+    code changed.
+
+    Each build writes a new data-<id>/ directory and then points meta.json at it, so readers (and
+    their memory maps) never see a half-written or truncated file.
+    """
+
+    def __init__(self, path, attempts=3):
+        self.path = path
+        for attempt in range(attempts):
+            with open(os.path.join(path, "meta.json")) as f:
+                self.meta = json.load(f)
+            try:
+                self._open_data(os.path.join(path, self.meta["data"]))
+                break
+            except FileNotFoundError:
+                # A build in another process replaced meta.json and removed this data directory
+                # between the two reads, the new meta.json points at its data
+                if attempt == attempts - 1:
+                    raise
+                logger.debug(f"{path} was rebuilt while opening it, retrying")
+
+    def _open_data(self, data_path):
+        self.index = columnar.ColumnarReader(os.path.join(data_path, "index.parquet")).table()
+
+        self._bodies_file = open(os.path.join(data_path, "bodies.bin"), "rb")
+        # mmap can't map an empty file
+        self._bodies = mmap.mmap(self._bodies_file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(os.path.join(data_path, "bodies.bin")) else b""
+        self._offsets = self.index["offset"].to_numpy()
+        self._lengths = self.index["length"].to_numpy()
+
+    @classmethod
+    def build(cls, mailbox_path, path=None):
+        """Parses mailbox_path (JSONL of {subject, body, from, to, date?}) into an index at path."""
+        path = path or index_path(mailbox_path)
+        os.makedirs(path, exist_ok=True)
+        with _build_lock(path):
+            return cls._build(mailbox_path, path)
+
+    @classmethod
+    def _build(cls, mailbox_path, path):
+        data = f"data-{uuid.uuid4().hex[:12]}"
+        data_path = os.path.join(path, data)
+        os.makedirs(data_path)
+
+        loads = _json_loads()
+        stamp = _source_stamp(mailbox_path)
+        start = time.perf_counter()
+
+        def rows(source, bodies):
+            source_offset = 0
+            offset = 0
+            for line in source:
+                source_length = len(line)
+                if not line.strip():
+                    source_offset += source_length
+                    continue
+
+                email = loads(line)
+                subject = email.get("subject") or ""
+                raw_body = email.get("body") or ""
+                text = email_cleaning.strip_quotes(raw_body)
+                body = text.encode("utf-8")
+                bodies.write(body)
+
+                yield {
+                    "subject": subject,
+                    "from": email.get("from"),
+                    "to": email.get("to"),
+                    "date": email.get("date"),
+                    "is_reply": subject.lower().startswith("re: "),
+                    "is_forward": subject.lower().startswith("fwd: ") or "--- forwarded message --- " in raw_body,
+                    "chars": len(text),
+                    "words": len(body.split()),
+                    "offset": offset,
+                    "length": len(body),
+                    "source_offset": source_offset,
+                    "source_length": source_length,
+                }
+                offset += len(body)
+                source_offset += source_length
+
+        import pyarrow as pa
+
+        types = {"is_reply": pa.bool_(), "is_forward": pa.bool_(), "chars": pa.int64(), "words": pa.int32(), "offset": pa.int64(), "length": pa.int64(), "source_offset": pa.int64(), "source_length": pa.int64()}
+        with open(mailbox_path, "rb") as source, open(os.path.join(data_path, "bodies.bin"), "wb") as bodies:
+            num_emails = columnar.write_table(os.path.join(data_path, "index.parquet"), rows(source, bodies), INDEX_COLUMNS, batch_size=8192, types=types)
+
+        # Switch readers to the new data in one step, then drop older builds. Open memory maps of
+        # those stay valid until they are closed.
+        tmp_path = os.path.join(path, f"meta.json.{data}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"source": os.path.abspath(mailbox_path), **stamp, "emails": num_emails, "data": data}, f)
+        os.replace(tmp_path, os.path.join(path, "meta.json"))
+
+        for name in os.listdir(path):
+            if name.startswith("data-") and name != data:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+            elif name in ("bodies.bin", "index.parquet"):
+                # Written directly in path before data directories
+                os.remove(os.path.join(path, name))
+
+        logger.info(f"Indexed {num_emails} e-mails from {mailbox_path} in {time.perf_counter() - start:.1f}s")
+        return cls(path)
+
+    @classmethod
+    def open(cls, mailbox_path, path=None):
+        """The index of mailbox_path, built or rebuilt if it is missing or out of date."""
+        path = path or index_path(mailbox_path)
+        if _is_current(mailbox_path, path):
+            return cls(path)
+
+        os.makedirs(path, exist_ok=True)
+        with _build_lock(path):
+            # Another process may have built it while this one waited for the lock
+            if _is_current(mailbox_path, path):
+                return cls(path)
+            return cls._build(mailbox_path, path)
+
+    def __len__(self):
+        return self.index.num_rows
+
+    def select(self, subject_contains=None, replies=True, forwards=True, min_chars=0, since=None, until=None):
+        """
+        Row numbers of the e-mails matching every given condition, in mailbox order.
+
+        Parameters:
+        - subject_contains: Case-insensitive substring of the subject.
+        - replies / forwards: False to leave out replies ("Re: ") or forwards.
+        - since / until: Bounds on the date field, compared as strings so ISO 8601 dates work.
+        """
+        import pyarrow.compute as pc
+
+        mask = np.ones(len(self), dtype=bool)
+        if subject_contains:
+            mask &= pc.match_substring(self.index["subject"], subject_contains, ignore_case=True).to_numpy(zero_copy_only=False)
+        if not replies:
+            mask &= ~self.index["is_reply"].to_numpy(zero_copy_only=False)
+        if not forwards:
+            mask &= ~self.index["is_forward"].to_numpy(zero_copy_only=False)
+        if min_chars:
+            mask &= self.index["chars"].to_numpy() >= min_chars
+        if since is not None:
+            mask &= pc.fill_null(pc.greater_equal(self.index["date"], since), False).to_numpy(zero_copy_only=False)
+        if until is not None:
+            mask &= pc.fill_null(pc.less(self.index["date"], until), False).to_numpy(zero_copy_only=False)
+
+        return np.flatnonzero(mask)
+
+    def body(self, row):
+        """The quote-stripped body of row, read from the memory map."""
+        offset = int(self._offsets[row])
+        return self._bodies[offset:offset + int(self._lengths[row])].decode("utf-8")
+
+    def records(self, rows=None, columns=("subject", "from", "to", "date")):
+        """Yields {columns..., "body"} dicts for rows (all by default) in the given order."""
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        table = self.index.select(list(columns))
+        for start in range(0, len(rows), 4096):
+            chunk = rows[start:start + 4096]
+            for row, record in zip(chunk, table.take(chunk).to_pylist()):
+                record["body"] = self.body(row)
+                yield record
@@ -0,0 +1,83 @@
+import re
+import zlib
+from collections import defaultdict
+import numpy as np
+
+_word = re.compile(r"\w+")
+# Largest prime below 2^32: hash values and coefficients stay under 2^32, so a * x + b fits in uint64
+_PRIME = np.uint64(4294967291)
+
+
+def shingles(text, size=5):
+    """Hashes of the text's overlapping size-word windows (the whole text if it is shorter)."""
+    words = [w.lower() for w in _word.findall(text or "")]
+    if len(words) <= size:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))}
+    return {zlib.crc32(" ".join(words[i:i + size]).encode("utf-8")) for i in range(len(words) - size + 1)}
+
+
+def lsh_bands(threshold, num_perm):
+    """
+    Picks (bands, rows) with bands * rows <= num_perm whose LSH S-curve, (1 / bands) ** (1 / rows),
+    crosses closest to the Jaccard threshold.
+    """
+    return min(((b, num_perm // b) for b in range(1, num_perm + 1)), key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+
+class NearDuplicateFilter:
+    """
+    Streaming near-duplicate detection with MinHash signatures and LSH banding.
+
+    Texts are added one at a time; each is either new (it becomes the representative of its
+    cluster) or a near-duplicate of an earlier representative, i.e. their estimated Jaccard
+    similarity over word shingles is at least the threshold. Only representatives are kept, so
+    memory grows with the number of distinct texts.
+
+    Parameters:
+    - threshold: Jaccard similarity at or above which two texts are duplicates.
+    - num_perm: MinHash permutations, more is more accurate and slower.
+    - shingle_size: Words per shingle.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=128, shingle_size=5, seed=0):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, int(_PRIME), size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, int(_PRIME), size=num_perm, dtype=np.uint64)
+
+        self.buckets = [defaultdict(list) for _ in range(self.bands)]
+        self.signatures = {}
+        self.duplicates = {}
+
+    def signature(self, text):
+        values = np.fromiter(shingles(text, self.shingle_size), dtype=np.uint64)
+        # One universal hash per permutation over every shingle at once, keep the minimum of each
+        return ((np.outer(self.a, values) + self.b[:, None]) % _PRIME).min(axis=1)
+
+    def add(self, key, text):
+        """Returns the key of the representative this text duplicates, or None if it is new."""
+        signature = self.signature(text)
+        bands = [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+        candidates = {candidate for band, bucket in zip(bands, self.buckets) for candidate in bucket.get(band, ())}
+        best, best_similarity = None, self.threshold
+        for candidate in candidates:
+            similarity = float(np.mean(self.signatures[candidate] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+
+        if best is not None:
+            self.duplicates[key] = best
+            return best
+
+        self.signatures[key] = signature
+        for band, bucket in zip(bands, self.buckets):
+            bucket[band].append(key)
+        return None
+
+    def __len__(self):
+        return len(self.signatures)
@@ -0,0 +1,129 @@
+import itertools
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class Stage:
+    """
+    One step of a pipeline: fn(item) runs on workers threads and returns the item for the next
+    stage, or None to drop it.
+    """
+
+    def __init__(self, name, fn, workers=4):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+
+
+class _Queue:
+    # Bounded priority queue: put blocks while it is full (backpressure), get returns the highest
+    # priority item buffered. Puts and gets give up when the pipeline is stopped.
+    def __init__(self, capacity, stopped):
+        self._queue = queue.PriorityQueue(maxsize=capacity)
+        self._stopped = stopped
+        self._order = itertools.count()
+
+    def put(self, item, priority=0.0):
+        entry = (-priority, next(self._order), item)
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def end(self):
+        # Sorts after every item, so workers drain the queue before they see it
+        while not self._stopped.is_set():
+            try:
+                self._queue.put((float("inf"), next(self._order), _END), timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        while not self._stopped.is_set():
+            try:
+                return self._queue.get(timeout=0.1)[2]
+            except queue.Empty:
+                pass
+        return _END
+
+
+def run_pipeline(items, stages, window=32, priority=None):
+    """
+    Streams items through stages, each with its own worker pool, yielding the outputs of the last
+    stage as they complete.
+
+    Parameters:
+    - items: Any iterable, read only as fast as the first stage takes items.
+    - stages: Stage objects, in order.
+    - window: Items buffered in front of each stage. Memory stays bounded by the windows and
+      workers whatever the corpus size, and a slow stage holds back the ones before it.
+    - priority: Optional priority(item), highest first within each window. Longest-first (e.g. the
+      length of the e-mail) keeps the slowest items from landing at the end of the run.
+
+    Exceptions raised by a stage stop the pipeline and are raised here.
+    """
+    priority = priority or (lambda item: 0.0)
+    stopped = threading.Event()
+    errors = []
+    queues = [_Queue(window, stopped) for _ in stages] + [_Queue(window, stopped)]
+
+    def feed():
+        try:
+            for item in items:
+                if not queues[0].put(item, priority(item)):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stopped.set()
+        finally:
+            for _ in range(stages[0].workers):
+                queues[0].end()
+
+    def work(index, stage, remaining):
+        inbox, outbox = queues[index], queues[index + 1]
+        try:
+            while (item := inbox.get()) is not _END:
+                result = stage.fn(item)
+                if result is not None and not outbox.put(result, priority(result)):
+                    return
+        except BaseException as e:
+            logger.exception(f"Pipeline stage {stage.name} failed")
+            errors.append(e)
+            stopped.set()
+        finally:
+            with remaining[1]:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                # The next stage ends once every worker of this one is done
+                for _ in range(stages[index + 1].workers if index + 1 < len(stages) else 1):
+                    outbox.end()
+
+    threads = [threading.Thread(target=feed, name="pipeline-feed", daemon=True)]
+    for index, stage in enumerate(stages):
+        remaining = [stage.workers, threading.Lock()]
+        threads.extend(threading.Thread(target=work, args=(index, stage, remaining), name=f"pipeline-{stage.name}-{i}", daemon=True) for i in range(stage.workers))
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while (result := queues[-1].get()) is not _END:
+            yield result
+    finally:
+        # Also reached when the consumer stops early
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
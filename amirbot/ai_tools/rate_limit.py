@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Classic token bucket refilled continuously at rate_per_minute, holding at most capacity
+    tokens (defaults to one minute's worth). acquire() blocks until the tokens are available.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        # Requests larger than the whole bucket wait for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """
+    Enforces requests/minute and tokens/minute budgets shared by every thread in the process.
+    Either budget can be None to leave it unlimited.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, tokens=0):
+        if self.requests:
+            self.requests.acquire(1)
+        if self.tokens and tokens:
+            self.tokens.acquire(tokens)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD concurrency limit: the number of in-flight requests grows by roughly one per round of
+    healthy responses (latency under target_latency) and is halved when the API answers 429,
+    at most once per cooldown seconds so a burst of 429s from the same window counts once.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=32, target_latency=60.0, cooldown=5.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+
+        self.in_flight = 0
+        self.rate_limited = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, rate_limited=False):
+        logger = logging.getLogger(__name__)
+
+        with self._cond:
+            self.in_flight -= 1
+
+            now = time.monotonic()
+            if rate_limited:
+                self.rate_limited += 1
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._last_decrease = now
+                    logger.warning(f"Rate limited, reducing LM concurrency to {int(self.limit)}")
+            elif latency <= self.target_latency:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.min_limit, self.limit * 0.9)
+                self._last_decrease = now
+
+            self._cond.notify_all()
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+def content_hash(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def read_records(path):
+    """
+    Streams (key, record) pairs from an append-only record log. A partially written last line
+    (e.g. the process was killed mid-write) is ignored.
+    """
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            entry = json.loads(line)
+            yield entry["key"], entry["record"]
+
+
+def completed_keys(path):
+    return {key for key, _ in read_records(path)}
+
+
+class RecordLog:
+    """
+    Append-only JSONL store with one {"key": ..., "record": ...} entry per line.
+
+    Each append is flushed immediately, while fsync is batched to every fsync_every records or
+    fsync_interval seconds, whichever comes first. Safe to share between threads.
+    """
+
+    def __init__(self, path, fsync_every=20, fsync_interval=5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+        self._truncate_partial_line()
+        self._f = open(path, "ab")
+
+    def _truncate_partial_line(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+
+            # Walk back to the end of the last complete record and drop the torn write
+            pos = size
+            while pos > 0:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step)
+                idx = chunk.rfind(b"\n")
+                if idx != -1:
+                    pos += idx + 1
+                    break
+
+            logging.getLogger(__name__).warning(f"Dropping {size - pos} bytes of partially written record from {self.path}")
+            f.truncate(pos)
+
+    def append(self, key, record):
+        line = json.dumps({"key": key, "record": record}).encode("utf-8") + b"\n"
+
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+            self._pending += 1
+
+            if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._f.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._f.closed:
+                return
+            self._f.flush()
+            self._sync()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
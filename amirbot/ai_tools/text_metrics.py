@@ -0,0 +1,68 @@
+import re
+import numpy as np
+
+_word = re.compile(r"\w+")
+# Numbers, amounts and capitalized words that do not start a sentence are a cheap proxy for the
+# facts an e-mail carries (figures, names, products)
+_fact = re.compile(r"\$?\d[\d,.]*%?|(?<![.!?]\s)(?<!^)\b[A-Z][a-zA-Z]+", re.MULTILINE)
+
+
+def _lengths(texts, unit):
+    if unit == "chars":
+        return np.array([len(t or "") for t in texts], dtype=np.float64)
+    return np.array([len(_word.findall(t or "")) for t in texts], dtype=np.float64)
+
+
+def length_ratios(candidates, references, unit="words"):
+    """len(candidate) / len(reference) for each pair, in words or chars. 0 where the reference is empty."""
+    candidate_lengths = _lengths(candidates, unit)
+    reference_lengths = _lengths(references, unit)
+    return np.divide(candidate_lengths, reference_lengths, out=np.zeros_like(candidate_lengths), where=reference_lengths > 0)
+
+
+def _ngrams(text, n):
+    words = [w.lower() for w in _word.findall(text or "")]
+    return set(zip(*(words[i:] for i in range(n))))
+
+
+def ngram_recall(candidates, references, n=1):
+    """Fraction of each reference's distinct n-grams that also appear in its candidate."""
+    recalls = np.zeros(len(references))
+    for i, (candidate, reference) in enumerate(zip(candidates, references)):
+        reference_ngrams = _ngrams(reference, n)
+        if reference_ngrams:
+            recalls[i] = len(reference_ngrams & _ngrams(candidate, n)) / len(reference_ngrams)
+    return recalls
+
+
+def key_fact_recall(candidates, references):
+    """Fraction of each reference's key facts (numbers, names) that appear in its candidate. 1 if it has none."""
+    recalls = np.ones(len(references))
+    for i, (candidate, reference) in enumerate(zip(candidates, references)):
+        facts = {f.lower().rstrip(".,") for f in _fact.findall(reference or "")}
+        if facts:
+            candidate_text = (candidate or "").lower()
+            recalls[i] = sum(1 for f in facts if f in candidate_text) / len(facts)
+    return recalls
+
+
+def paragraph_similarity(candidates, references):
+    """
+    Structural similarity in [0, 1] from paragraph counts and mean paragraph length (in words):
+    the product of min/max ratios of the two, so identical layouts score 1.
+    """
+    def shape(texts):
+        counts, means = [], []
+        for text in texts:
+            paragraphs = [p for p in re.split(r"\n\s*\n", text or "") if p.strip()]
+            counts.append(len(paragraphs))
+            means.append(np.mean([len(_word.findall(p)) for p in paragraphs]) if paragraphs else 0)
+        return np.array(counts, dtype=np.float64), np.array(means, dtype=np.float64)
+
+    def ratio(a, b):
+        high = np.maximum(a, b)
+        return np.divide(np.minimum(a, b), high, out=np.zeros_like(high), where=high > 0)
+
+    candidate_counts, candidate_means = shape(candidates)
+    reference_counts, reference_means = shape(references)
+    return ratio(candidate_counts, reference_counts) * ratio(candidate_means, reference_means)
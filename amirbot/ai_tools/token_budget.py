@@ -0,0 +1,73 @@
+import functools
+import os
+import re
+
+# Words, digit runs and single punctuation marks; whitespace is folded into the following piece
+_piece = re.compile(r"[^\W\d_]+|\d+|_+|[^\w\s]")
+
+_encoding = None
+
+
+def _tiktoken():
+    # Opt-in with TOKENIZER=tiktoken: exact counts, but tiktoken fetches its BPE file on first use
+    # unless it is already in TIKTOKEN_CACHE_DIR
+    global _encoding
+    if _encoding is None and os.getenv("TOKENIZER") == "tiktoken":
+        import tiktoken
+        _encoding = tiktoken.get_encoding(os.getenv("TIKTOKEN_ENCODING", "cl100k_base"))
+    return _encoding
+
+
+def _piece_tokens(piece):
+    # Approximates the cl100k BPE: digits go in groups of three, common words are one token and
+    # longer words split roughly every five characters
+    if piece[0].isdigit():
+        return (len(piece) + 2) // 3
+    return 1 + (len(piece) - 1) // 5
+
+
+# Compiled demos are the same strings on every call, so their counts are worth keeping
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text):
+    """Token count of text, computed locally."""
+    encoding = _tiktoken()
+    if encoding is not None:
+        return len(encoding.encode(text or ""))
+    return sum(_piece_tokens(match.group()) for match in _piece.finditer(text or ""))
+
+
+def truncate(text, max_tokens):
+    """The longest prefix of text within max_tokens, cut between tokens and keeping the original whitespace."""
+    encoding = _tiktoken()
+    if encoding is not None:
+        tokens = encoding.encode(text or "")
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+    used = 0
+    for match in _piece.finditer(text or ""):
+        used += _piece_tokens(match.group())
+        if used > max_tokens:
+            return text[:match.start()].rstrip()
+    return text
+
+
+def fit_demos(demos, budget, fields):
+    """
+    Picks demos that fit in a token budget.
+
+    Parameters:
+    - demos: Candidate demos, most relevant first (dicts or dspy Examples).
+    - budget: Tokens available for all demos together.
+    - fields: The demo fields that end up in the prompt.
+
+    Returns:
+    - The demos that fit, in their original order. A demo too big for what is left is skipped so a
+      smaller, less relevant one can still be used.
+    """
+    selected = []
+    for demo in demos:
+        size = sum(count_tokens(str(demo.get(field) or "")) for field in fields)
+        if size <= budget:
+            selected.append(demo)
+            budget -= size
+    return selected
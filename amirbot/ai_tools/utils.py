@@ -1,31 +1,109 @@
-from sklearn.model_selection import train_test_split
+import hashlib
+import json
+import logging
+from collections import Counter, defaultdict
 
-def split_dataset(data, train_size, validate_size, test_size):
+from amirbot.ai_tools.record_log import content_hash
+
+SPLITS = ("train", "validate", "test")
+
+
+def _default_key(item):
+    if hasattr(item, "toDict"):
+        item = item.toDict()
+    if isinstance(item, dict):
+        return json.dumps(item, sort_keys=True, default=str)
+    return str(item)
+
+
+def hash_fraction(key, seed=0):
+    """Maps a key to a stable number in [0, 1), identical across runs, processes and machines."""
+    digest = hashlib.sha256(f"{seed}\0{key}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+def example_key(example):
+    """
+    Stable key of an e-mail example from its subject, sender, recipients and body. Record logs,
+    dataset splits and bucket assignments in the scripts are keyed by it.
+    """
+    return content_hash(example.email_subject, example.email_from, example.email_to, example.email_body)
+
+
+def _check_sizes(train_size, validate_size, test_size):
+    # Ensure that the percentages add up to 1 (or 100%)
+    if abs(train_size + validate_size + test_size - 1) > 1e-9:
+        raise ValueError("The sum of train, validate, and test sizes must equal 1")
+
+
+def assign_split(key, train_size, validate_size, test_size, seed=0):
+    _check_sizes(train_size, validate_size, test_size)
+
+    fraction = hash_fraction(key, seed)
+    if fraction < train_size:
+        return "train"
+    if fraction < train_size + validate_size:
+        return "validate"
+    return "test"
+
+
+def iter_split(data, split, train_size, validate_size, test_size, key=None, seed=0):
+    """
+    Streams the items of one split out of any iterable without materializing it. Each item's split
+    depends only on its key and the seed, so it never changes as the corpus grows or is reordered.
+    """
+    key = key or _default_key
+    for item in data:
+        if assign_split(key(item), train_size, validate_size, test_size, seed) == split:
+            yield item
+
+
+def split_dataset(data, train_size, validate_size, test_size, key=None, seed=0, stratify=None):
     """
     Splits the dataset into training, validation, and test sets based on the specified percentages.
-    
+
+    Assignment is deterministic: each item is placed by a hash of key(item) and the seed, so the
+    same corpus always produces the same splits regardless of input order.
+
     Parameters:
-    - data: The complete dataset as a list of TrainingExamples.
+    - data: Any iterable of examples; it is consumed once.
     - train_size: The percentage of the dataset to allocate to the training set.
     - validate_size: The percentage of the dataset to allocate to the validation set.
     - test_size: The percentage of the dataset to allocate to the test set.
-    
+    - key: Function returning the content to hash for an item. Defaults to the item's fields.
+    - seed: Changes the assignment while keeping it reproducible.
+    - stratify: Optional function returning an item's group (e.g. email bucket). Each group is then
+      ordered by hash and cut at the requested proportions, so every group is split exactly.
+
     Returns:
     - A tuple containing the training set, validation set, and test set.
     """
-    
-    # Ensure that the percentages add up to 1 (or 100%)
-    if (train_size + validate_size + test_size) != 1:
-        raise ValueError("The sum of train, validate, and test sizes must equal 1")
-    
-    # First split to separate out the training set
-    initial_train_size = train_size + validate_size
-    train_val_set, test_set = train_test_split(data, test_size=test_size, shuffle=True)
-    
-    # Adjust validate_size for the second split
-    validate_size_adjusted = validate_size / initial_train_size
-    
-    # Second split to separate out the validation set from the training set
-    train_set, validate_set = train_test_split(train_val_set, test_size=validate_size_adjusted, shuffle=True)
-    
-    return train_set, validate_set, test_set
\ No newline at end of file
+    _check_sizes(train_size, validate_size, test_size)
+    key = key or _default_key
+
+    if stratify is None:
+        splits = {name: [] for name in SPLITS}
+        for item in data:
+            splits[assign_split(key(item), train_size, validate_size, test_size, seed)].append(item)
+        return splits["train"], splits["validate"], splits["test"]
+
+    groups = defaultdict(list)
+    for item in data:
+        group = stratify(item)
+        groups[group].append((hash_fraction(f"{group}\0{key(item)}", seed), item))
+
+    train_set, validate_set, test_set = [], [], []
+    counts = {}
+    for group, items in sorted(groups.items(), key=lambda g: str(g[0])):
+        items.sort(key=lambda pair: pair[0])
+        train_end = round(len(items) * train_size)
+        validate_end = train_end + round(len(items) * validate_size)
+
+        train_set.extend(item for _, item in items[:train_end])
+        validate_set.extend(item for _, item in items[train_end:validate_end])
+        test_set.extend(item for _, item in items[validate_end:])
+        counts[group] = Counter(train=train_end, validate=validate_end - train_end, test=len(items) - validate_end)
+
+    logging.getLogger(__name__).debug(f"Stratified split per group: {counts}")
+
+    return train_set, validate_set, test_set
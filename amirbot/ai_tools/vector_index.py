@@ -0,0 +1,105 @@
+import json
+import os
+import re
+import zlib
+import numpy as np
+
+_token = re.compile(r"\w+")
+
+
+def hashed_counts(texts, dims):
+    """Bag-of-words term counts per text, hashed into dims columns with a hash that is stable across runs."""
+    matrix = np.zeros((len(texts), dims), dtype=np.float32)
+    for i, text in enumerate(texts):
+        buckets = [zlib.crc32(token.encode("utf-8")) % dims for token in _token.findall((text or "").lower())]
+        if buckets:
+            matrix[i] = np.bincount(buckets, minlength=dims)
+    return matrix
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def idf_weights(document_frequency, num_documents):
+    """Smoothed inverse document frequency per hashed column."""
+    return (np.log((1 + num_documents) / (1 + np.asarray(document_frequency))) + 1).astype(np.float32)
+
+
+def tfidf_vectors(texts, idf):
+    """L2 normalized sublinear TF-IDF vectors of texts, one float32 row per text."""
+    return _normalize(np.log1p(hashed_counts(texts, len(idf))) * idf)
+
+
+class VectorIndex:
+    """
+    Local TF-IDF index over a set of texts with cosine top-k search, no database required.
+
+    Vectors are hashed TF-IDF (sublinear tf), L2 normalized float32, so cosine similarity is a
+    single matrix-vector product. A saved index is a directory holding vectors.npy, idf.npy and
+    records.json; load() memory-maps the vectors so opening it is cheap and pages are shared
+    between processes.
+    """
+
+    def __init__(self, vectors, idf, records):
+        self.vectors = vectors
+        self.idf = idf
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    @classmethod
+    def build(cls, texts, records=None, dims=4096):
+        """
+        Parameters:
+        - texts: The texts to index.
+        - records: Payload returned by search() for each text (any JSON-serializable value), defaults to the text.
+        - dims: Number of hashed feature columns.
+        """
+        texts = list(texts)
+        records = list(records) if records is not None else texts
+        if len(records) != len(texts):
+            raise ValueError(f"Got {len(records)} records for {len(texts)} texts")
+
+        idf = idf_weights(np.count_nonzero(hashed_counts(texts, dims), axis=0), len(texts))
+        return cls(tfidf_vectors(texts, idf), idf, records)
+
+    def embed(self, texts):
+        return tfidf_vectors(texts, self.idf)
+
+    def search_many(self, texts, k=3, min_score=0.0):
+        """Returns, per query text, up to k (record, cosine score) pairs, best first."""
+        if not len(self.records):
+            return [[] for _ in texts]
+
+        scores = self.embed(texts) @ np.asarray(self.vectors).T
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+        results = []
+        for row, candidates in zip(scores, top):
+            ranked = candidates[np.argsort(-row[candidates])]
+            results.append([(self.records[i], float(row[i])) for i in ranked if row[i] > min_score])
+        return results
+
+    def search(self, text, k=3, min_score=0.0):
+        return self.search_many([text], k, min_score)[0]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        # Write everything to temporary names first so a reader never sees a half-updated index
+        for name, write in [("vectors.npy", lambda f: np.save(f, self.vectors)), ("idf.npy", lambda f: np.save(f, self.idf)), ("records.json", lambda f: f.write(json.dumps(self.records).encode("utf-8")))]:
+            with open(os.path.join(path, f".{name}.tmp"), "wb") as f:
+                write(f)
+        for name in ["vectors.npy", "idf.npy", "records.json"]:
+            os.replace(os.path.join(path, f".{name}.tmp"), os.path.join(path, name))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r" if mmap else None)
+        idf = np.load(os.path.join(path, "idf.npy"))
+        with open(os.path.join(path, "records.json")) as f:
+            records = json.load(f)
+        return cls(vectors, idf, records)
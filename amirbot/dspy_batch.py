@@ -0,0 +1,199 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import dspy
+from amirbot import dspy_lm
+from amirbot.ai_tools import batch_queue, record_log
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredRequest(BaseException):
+    """
+    Raised by an LM call that was queued for the next batch instead of sent. A BaseException so
+    the `except Exception` handlers around predictions and metrics let it through to BatchSession.
+    """
+
+
+# One request hook per LM client for all sessions, installed the first time a session needs it
+_hooks_lock = threading.Lock()
+_inner_requests = {}
+# The session inside run(), LM calls outside of one pass straight through
+_active_session = None
+
+
+def _install_hook(lm):
+    with _hooks_lock:
+        if id(lm) in _inner_requests:
+            return
+        _inner_requests[id(lm)] = lm.request
+
+        def batched_request(inner, prompt, **kwargs):
+            session = _active_session
+            if session is None:
+                return inner(prompt, **kwargs)
+            return session.answer(lm, prompt, kwargs)
+
+        # Outermost wrapper on request
+        dspy_lm.wrap_method(lm, "request", batched_request)
+
+
+class BatchSession:
+    """
+    Runs latency-insensitive stages (synthesis, evaluations) against a batch executor instead of
+    interactive calls.
+
+    While run() is active, an LM call whose answer isn't known yet is queued and the item that made
+    it is parked. Each round writes the queued prompts to a request file, hands it to the executor
+    and replays the parked items: known answers return immediately, the next step of a multi-call
+    program gets queued. Rounds repeat until every item finishes, so results come back as the
+    usual dspy objects. All answers are kept in a record log in the session directory, so a
+    restarted job replays what it already paid for.
+    """
+
+    def __init__(self, path, executor=None, lms=(), cache=None, threads=32, concurrency=64, max_rounds=50):
+        """
+        Parameters:
+        - path: Directory for the request files and the results log.
+        - executor: Anything with run(requests_path, results_path), defaults to a LocalBatchExecutor
+          sending through the installed LMs.
+        - lms: dspy clients to install the session on, see install().
+        - cache: Optional ai_tools.lm_cache.ResponseCache, answers found there are never queued and
+          answers from the executor are added to it.
+        """
+        self.path = path
+        self.results_path = os.path.join(path, "results.jsonl")
+        self.executor = executor or batch_queue.LocalBatchExecutor(self.send, concurrency=concurrency)
+        self.cache = cache
+        self.threads = threads
+        self.max_rounds = max_rounds
+
+        self._lock = threading.Lock()
+        self._results = {}
+        self._deferred = {}
+        self._labels = {}
+        self._lms = {}
+        self.install(*lms)
+
+    def install(self, *lms):
+        # Every session shares one hook per client, so creating sessions per stage or per trained
+        # bucket doesn't stack wrappers on the clients
+        for lm in lms:
+            _install_hook(lm)
+            self._lms[dspy_lm.request_kwargs(lm, {}).get("model")] = lm
+
+    def answer(self, lm, prompt, kwargs):
+        """A known answer to an LM call made inside run(), otherwise queues it and raises DeferredRequest."""
+        key = dspy_lm.request_key(lm, prompt, kwargs)
+        response = self._results.get(key)
+        if response is None and self.cache is not None:
+            response = self.cache.get(key)
+        if response is not None:
+            lm.history.append({"prompt": prompt, "response": response, "kwargs": dspy_lm.request_kwargs(lm, kwargs), "raw_kwargs": kwargs, "batched": True})
+            return response
+
+        with self._lock:
+            self._deferred[key] = {**dspy_lm.request_kwargs(lm, kwargs), "messages": [{"role": "user", "content": prompt}]}
+            self._labels[key] = dspy_lm.current_label()
+        raise DeferredRequest(key)
+
+    def send(self, key, body):
+        """Answers one queued request through the LM that queued it, for the local executor."""
+        lm = self._lms[body["model"]]
+        kwargs = {name: value for name, value in body.items() if name != "messages"}
+        with dspy_lm.label_context(self._labels.get(key)):
+            return _inner_requests[id(lm)](body["messages"][0]["content"], **kwargs)
+
+    def run(self, items, fn, desc="items"):
+        """
+        Returns [fn(item) for item in items], with fn's LM calls answered in batches.
+
+        fn must be deterministic given the LM answers so a replayed item asks the same prompts.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self._results.update(record_log.read_records(self.results_path))
+
+        outputs = [None] * len(items)
+        remaining = list(range(len(items)))
+        config = dict(dspy.settings.config)
+
+        def attempt(i):
+            with dspy.context(**config):
+                try:
+                    return i, fn(items[i]), False
+                except DeferredRequest:
+                    return i, None, True
+
+        global _active_session
+        with _hooks_lock:
+            if _active_session is not None:
+                raise RuntimeError(f"Batch session {_active_session.path} is already running, sessions can't run concurrently")
+            _active_session = self
+        try:
+            for batch_round in range(1, self.max_rounds + 1):
+                self._deferred = {}
+                with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                    results = list(executor.map(attempt, remaining))
+
+                remaining = [i for i, _, deferred in results if deferred]
+                for i, output, deferred in results:
+                    if not deferred:
+                        outputs[i] = output
+
+                if not remaining:
+                    return outputs
+
+                requests_path = os.path.join(self.path, f"requests-{batch_round:04d}.jsonl")
+                batch_queue.write_requests(requests_path, self._deferred.items())
+                logger.info(f"Round {batch_round}: {len(remaining)} {desc} waiting on {len(self._deferred)} LM requests, queued in {requests_path}")
+                self.executor.run(requests_path, self.results_path)
+
+                answered = 0
+                for key, response in record_log.read_records(self.results_path):
+                    if key in self._deferred and key not in self._results:
+                        answered += 1
+                        if self.cache is not None:
+                            # Batch API answers don't pass through the LM's cache hook, store them
+                            # so interactive calls and other stages reuse them too
+                            body = self._deferred[key]
+                            self.cache.set(key, response, model=body.get("model"), temperature=body.get("temperature"), max_tokens=body.get("max_tokens"))
+                    self._results[key] = response
+                if not answered:
+                    raise RuntimeError(f"No request in {requests_path} was answered, see the executor's log")
+
+            raise RuntimeError(f"{len(remaining)} {desc} still waiting on LM requests after {self.max_rounds} rounds")
+        finally:
+            _active_session = None
+
+
+# Latency-insensitive stages (synthesis and final evaluations in scripts 1 and 2) can run as batch
+# jobs: "openai" submits each round to the OpenAI Batch API (cheaper, much higher quota, answers
+# within 24h), "local" answers each round in-process with LM_BATCH_CONCURRENCY concurrent calls.
+# Rerunning an interrupted job resumes from LM_BATCH_DIR.
+# LM_BATCH=openai
+# LM_BATCH_DIR=.batches
+# LM_BATCH_CONCURRENCY=64
+# LM_BATCH_POLL_SECONDS=60
+def batch_session(stage):
+    """The BatchSession for stage (a directory name under LM_BATCH_DIR), None unless LM_BATCH is set."""
+    mode = os.getenv("LM_BATCH")
+    if not mode:
+        return None
+
+    from amirbot.dspy_config import gpt4, lm_cache, turbo
+
+    if mode == "openai":
+        executor = batch_queue.OpenAIBatchExecutor(poll_interval=float(os.getenv("LM_BATCH_POLL_SECONDS", "60")))
+    elif mode == "local":
+        executor = None
+    else:
+        raise ValueError(f"LM_BATCH must be 'openai' or 'local', got {mode!r}")
+
+    return BatchSession(
+        os.path.join(os.getenv("LM_BATCH_DIR", ".batches"), stage),
+        executor,
+        lms=(turbo, gpt4),
+        cache=lm_cache,
+        concurrency=int(os.getenv("LM_BATCH_CONCURRENCY", "64"))
+    )
@@ -1,7 +1,120 @@
+import atexit
 import dspy
+import json
 import os
-turbo = dspy.OpenAI(model=os.getenv("FAST_OPENAI_MODEL"), api_key=os.getenv("OPENAI_API_KEY"), temperature=0.7, max_tokens=1000)
-gpt4 = dspy.OpenAI(model=os.getenv("SMART_OPENAI_MODEL"), api_key=os.getenv("OPENAI_API_KEY"), temperature=0.7, max_tokens=1000)
-# gpt4 = None
+from amirbot import dspy_lm
+from amirbot.ai_tools.lm_cache import ResponseCache
+from amirbot.ai_tools.lm_metrics import MetricsRegistry
+from amirbot.ai_tools.rate_limit import AdaptiveConcurrency, RateLimiter
 
-dspy.settings.configure(lm=turbo, trace=[])
\ No newline at end of file
+# AMIRBOT_FAKE_LM=1 swaps in the offline FakeLM for benchmarks and dry runs
+# FAKE_LM_LATENCY_MEDIAN=0.5
+# FAKE_LM_LATENCY_SIGMA=0.5
+if os.getenv("AMIRBOT_FAKE_LM"):
+    from amirbot.fake_lm import FakeLM
+
+    fake_latency = dict(
+        latency_median=float(os.getenv("FAKE_LM_LATENCY_MEDIAN", "0")),
+        latency_sigma=float(os.getenv("FAKE_LM_LATENCY_SIGMA", "0")),
+        seconds_per_token=float(os.getenv("FAKE_LM_SECONDS_PER_TOKEN", "0"))
+    )
+    turbo = FakeLM(model="fake-turbo", temperature=0.7, max_tokens=1000, **fake_latency)
+    gpt4 = FakeLM(model="fake-gpt4", temperature=0.7, max_tokens=1000, **fake_latency)
+else:
+    turbo = dspy.OpenAI(model=os.getenv("FAST_OPENAI_MODEL"), api_key=os.getenv("OPENAI_API_KEY"), temperature=0.7, max_tokens=1000)
+    gpt4 = dspy.OpenAI(model=os.getenv("SMART_OPENAI_MODEL"), api_key=os.getenv("OPENAI_API_KEY"), temperature=0.7, max_tokens=1000)
+    # gpt4 = None
+
+lm_metrics = MetricsRegistry()
+
+# Tail latency control, installed first so metrics see one logical call per predictor call. A call
+# still running after its predictor's p95 gets a duplicate request and the first answer wins, for
+# at most LM_HEDGE_MAX_RATIO of calls. A call without an answer by its deadline fails with
+# TimeoutError; deadlines are per predictor label (see dspy_lm.label_predictors) with a default.
+# LM_HEDGE=1
+# LM_HEDGE_MAX_RATIO=0.1
+# LM_DEADLINE_SECONDS=180
+# LM_DEADLINES='{"generate_notes": 120, "AssessNotesRubric": 30}'
+lm_deadlines = json.loads(os.getenv("LM_DEADLINES", "{}"))
+lm_default_deadline = float(os.getenv("LM_DEADLINE_SECONDS")) if os.getenv("LM_DEADLINE_SECONDS") else None
+if os.getenv("LM_HEDGE") or lm_deadlines or lm_default_deadline:
+    for lm in (turbo, gpt4):
+        dspy_lm.install_hedging(
+            lm,
+            lm_metrics,
+            deadlines=lm_deadlines,
+            default_deadline=lm_default_deadline,
+            max_hedge_ratio=float(os.getenv("LM_HEDGE_MAX_RATIO", "0.1")) if os.getenv("LM_HEDGE") else 0.0
+        )
+
+    if (lm_deadlines or lm_default_deadline) and not os.getenv("AMIRBOT_FAKE_LM"):
+        # Bounds the HTTP call of an abandoned attempt, which keeps running after the deadline
+        import openai
+        openai.timeout = max([lm_default_deadline or 0, *lm_deadlines.values()])
+
+# Per-predictor call counts, latency, tokens and cost. Installed before the cache so only real
+# API calls are counted. Dumped as JSON, or Prometheus text for a .prom path.
+# LM_METRICS_PATH=logs/lm_metrics.json
+# LM_METRICS_INTERVAL_SECONDS=300
+for lm in (turbo, gpt4):
+    dspy_lm.install_metrics(lm, lm_metrics)
+
+atexit.register(lm_metrics.log_summary)
+if os.getenv("LM_METRICS_PATH"):
+    atexit.register(lm_metrics.dump, os.getenv("LM_METRICS_PATH"))
+    if os.getenv("LM_METRICS_INTERVAL_SECONDS"):
+        lm_metrics.start_periodic_dump(os.getenv("LM_METRICS_PATH"), float(os.getenv("LM_METRICS_INTERVAL_SECONDS")))
+
+# LM_CACHE_PATH=.cache/lm_responses.db
+# LM_CACHE_MAX_ENTRIES=200000
+# LM_CACHE_MAX_BYTES=2000000000
+# LM_CACHE_MAX_AGE_DAYS=30
+lm_cache = None
+if os.getenv("LM_CACHE_PATH"):
+    max_entries = os.getenv("LM_CACHE_MAX_ENTRIES")
+    max_bytes = os.getenv("LM_CACHE_MAX_BYTES")
+    max_age_days = os.getenv("LM_CACHE_MAX_AGE_DAYS")
+
+    lm_cache = ResponseCache(
+        os.getenv("LM_CACHE_PATH"),
+        max_entries=int(max_entries) if max_entries else None,
+        max_bytes=int(max_bytes) if max_bytes else None,
+        max_age=float(max_age_days) * 86400 if max_age_days else None
+    )
+
+    for lm in (turbo, gpt4):
+        dspy_lm.install_cache(lm, lm_cache)
+
+    atexit.register(lm_cache.log_stats)
+
+# One limiter and concurrency controller shared by both clients since they draw on the same key.
+# OPENAI_MAX_REQUESTS_PER_MINUTE=500
+# OPENAI_MAX_TOKENS_PER_MINUTE=300000
+# LM_MAX_CONCURRENCY=32
+# LM_TARGET_LATENCY_SECONDS=60
+max_rpm = os.getenv("OPENAI_MAX_REQUESTS_PER_MINUTE")
+max_tpm = os.getenv("OPENAI_MAX_TOKENS_PER_MINUTE")
+rate_limiter = RateLimiter(requests_per_minute=int(max_rpm) if max_rpm else None, tokens_per_minute=int(max_tpm) if max_tpm else None)
+lm_concurrency = AdaptiveConcurrency(
+    initial=8,
+    max_limit=int(os.getenv("LM_MAX_CONCURRENCY", "32")),
+    target_latency=float(os.getenv("LM_TARGET_LATENCY_SECONDS", "60"))
+)
+
+for lm in (turbo, gpt4):
+    # Streams only inside dspy_lm.stream_lm_calls, e.g. WriteEmailFromTranscript.stream
+    dspy_lm.install_streaming(lm, lm_metrics)
+    dspy_lm.install_rate_limit(lm, rate_limiter, lm_concurrency)
+
+# Token budget for the email writer's notes plus demos, counted locally by ai_tools.token_budget
+# (TOKENIZER=tiktoken for exact counts). Lower budgets mean fewer demos: cheaper, faster calls
+# for some loss in style, measure it with 2_train_model.py's evaluation. Unset sends everything.
+# WRITER_PROMPT_BUDGET_TOKENS=3000
+writer_prompt_budget = int(os.getenv("WRITER_PROMPT_BUDGET_TOKENS")) if os.getenv("WRITER_PROMPT_BUDGET_TOKENS") else None
+
+# Cosine similarity (hashed TF-IDF) a past notes/email pair needs to the incoming notes to be used
+# as a demo by the writer; when none reaches it, the optimizer's compiled demos are used instead.
+# WRITER_DEMO_MIN_SIMILARITY=0.15
+writer_demo_min_similarity = float(os.getenv("WRITER_DEMO_MIN_SIMILARITY", "0.15"))
+
+dspy.settings.configure(lm=turbo, trace=[])
@@ -0,0 +1,84 @@
+import logging
+import re
+import dspy
+
+logger = logging.getLogger(__name__)
+
+PER_QUESTION = "per_question"
+BATCHED = "batched"
+
+_numbered_answer = re.compile(r"^\W*(?:q(?:uestion)?\s*)?(\d+)\W*(yes|no)\b", re.IGNORECASE | re.MULTILINE)
+_bare_answer = re.compile(r"^\W*(yes|no)\b", re.IGNORECASE)
+
+
+def is_yes(answer):
+    match = _bare_answer.match(answer or "")
+    return bool(match) and match.group(1).lower() == "yes"
+
+
+def format_questions(rubric):
+    return "\n".join(f"{i}. {question}" for i, question in enumerate(rubric.values(), 1))
+
+
+def parse_answers(text, num_questions):
+    """
+    Parses a batched judge answer into {question number: bool}.
+
+    Accepts "1: yes", "1. No - because ...", "**Q1** yes" and similar. If the answer has no
+    numbering but exactly one yes/no line per question, the lines are taken in order.
+    """
+    answers = {}
+    for number, answer in _numbered_answer.findall(text or ""):
+        number = int(number)
+        if 1 <= number <= num_questions and number not in answers:
+            answers[number] = answer.lower() == "yes"
+
+    if not answers:
+        lines = [line for line in (text or "").split("\n") if _bare_answer.match(line)]
+        if len(lines) == num_questions:
+            answers = {i: is_yes(line) for i, line in enumerate(lines, 1)}
+
+    return answers
+
+
+def judge(rubric, signature, batched_signature=None, mode=BATCHED, local_answers=None, **inputs):
+    """
+    Answers every question in the rubric about the given inputs.
+
+    Parameters:
+    - rubric: Ordered mapping of question name to question text.
+    - signature: Per-question signature with an assessment_question input and an assessment_score output.
+    - batched_signature: Same inputs but with assessment_questions / assessment_scores, asking all questions at once.
+    - mode: BATCHED asks everything in one call and only falls back to per-question calls for answers
+      that could not be parsed; PER_QUESTION issues one call per question.
+    - local_answers: Answers already decided by local checks (see ai_tools.text_metrics); those
+      questions are not sent to the LM.
+
+    Returns:
+    - A dict of question name to True (yes) / False (no), in rubric order.
+    """
+    answers = {name: answer for name, answer in (local_answers or {}).items() if name in rubric}
+    ask = {name: question for name, question in rubric.items() if name not in answers}
+    calls = 0
+
+    if mode == BATCHED and batched_signature is not None and ask:
+        pred = dspy.Predict(batched_signature)(assessment_questions=format_questions(ask), **inputs)
+        calls += 1
+
+        parsed = parse_answers(pred.assessment_scores, len(ask))
+        for number, name in enumerate(ask, 1):
+            if number in parsed:
+                answers[name] = parsed[number]
+
+        if len(answers) < len(rubric):
+            logger.warning(f"Could not parse {len(rubric) - len(answers)} of {len(ask)} batched judge answers, falling back to per-question calls: {pred.assessment_scores}")
+
+    for name in ask:
+        if name not in answers:
+            pred = dspy.Predict(signature)(assessment_question=rubric[name], **inputs)
+            calls += 1
+            answers[name] = is_yes(pred.assessment_score)
+
+    logger.debug(f"Judged {len(rubric)} questions with {calls} LM calls ({mode}, {len(rubric) - len(ask)} answered locally)")
+
+    return {name: answers[name] for name in rubric}
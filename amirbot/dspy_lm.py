@@ -0,0 +1,444 @@
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import dspy
+
+logger = logging.getLogger(__name__)
+
+
+def wrap_method(lm, name, wrapper):
+    """
+    Replaces lm.<name> on this instance only with wrapper(inner, prompt, **kwargs), where inner is
+    whatever was installed before. Wrappers installed later run outermost.
+
+    dspy's GPT3 client routes every completion through request() (which carries the backoff retry
+    loop) and then basic_request() (one actual API call), so hooks that must see each attempt wrap
+    basic_request and hooks that see logical calls wrap request.
+    """
+    inner = getattr(lm, name)
+    setattr(lm, name, functools.partial(wrapper, inner))
+    return lm
+
+
+def request_kwargs(lm, kwargs):
+    kwargs = {**lm.kwargs, **kwargs}
+    kwargs.pop("model_type", None)
+    return kwargs
+
+
+def request_key(lm, prompt, kwargs):
+    kwargs = request_kwargs(lm, kwargs)
+    payload = json.dumps({"prompt": prompt, "kwargs": kwargs}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def install_cache(lm, cache):
+    def cached_request(inner, prompt, **kwargs):
+        key = request_key(lm, prompt, kwargs)
+
+        response = cache.get(key)
+        if response is not None:
+            lm.history.append({"prompt": prompt, "response": response, "kwargs": request_kwargs(lm, kwargs), "raw_kwargs": kwargs, "cached": True})
+            return response
+
+        response = inner(prompt, **kwargs)
+
+        merged = request_kwargs(lm, kwargs)
+        cache.set(key, response, model=merged.get("model"), temperature=merged.get("temperature"), max_tokens=merged.get("max_tokens"))
+
+        return response
+
+    return wrap_method(lm, "request", cached_request)
+
+
+def estimate_tokens(lm, prompt, kwargs):
+    kwargs = request_kwargs(lm, kwargs)
+    return len(prompt) // 4 + kwargs.get("max_tokens", 0) * kwargs.get("n", 1)
+
+
+def is_rate_limit_error(e):
+    return getattr(e, "status_code", None) == 429
+
+
+def install_rate_limit(lm, limiter=None, concurrency=None):
+    # Wraps basic_request so every attempt made by dspy's backoff loop is counted and throttled
+    def limited_request(inner, prompt, **kwargs):
+        # A retry of a hedged attempt whose answer is no longer wanted stops before using quota
+        raise_if_abandoned()
+
+        if limiter is not None:
+            limiter.acquire(estimate_tokens(lm, prompt, kwargs))
+
+        if concurrency is None:
+            return inner(prompt, **kwargs)
+
+        concurrency.acquire()
+        start = time.monotonic()
+        rate_limited = False
+        try:
+            return inner(prompt, **kwargs)
+        except Exception as e:
+            rate_limited = is_rate_limit_error(e)
+            raise
+        finally:
+            concurrency.release(time.monotonic() - start, rate_limited)
+
+    return wrap_method(lm, "basic_request", limited_request)
+
+
+_local = threading.local()
+
+
+class AttemptAbandoned(Exception):
+    """
+    Raised by a retry of a hedged attempt that lost or missed its deadline. dspy's backoff only
+    retries openai errors, so this ends the abandoned attempt's retry loop.
+    """
+
+
+def raise_if_abandoned():
+    abandoned = getattr(_local, "abandoned", None)
+    if abandoned is not None and abandoned.is_set():
+        raise AttemptAbandoned()
+
+
+def predictor_label(predictor):
+    label = getattr(predictor, "metrics_label", None)
+    if label:
+        return label
+
+    signature = predictor.signature
+    return getattr(signature, "__name__", None) or type(signature).__name__
+
+
+def current_label():
+    return getattr(_local, "label", None) or "unlabelled"
+
+
+@contextlib.contextmanager
+def label_context(label):
+    """Attributes LM calls made on this thread to label, for calls made outside the predictor."""
+    previous = getattr(_local, "label", None)
+    _local.label = label
+    try:
+        yield
+    finally:
+        _local.label = previous
+
+
+def label_predictors(module):
+    """Labels every predictor of a dspy module with its attribute name, e.g. generate_notes."""
+    for name, predictor in module.named_predictors():
+        predictor.metrics_label = name
+    return module
+
+
+def install_predictor_labels():
+    # Record which predictor is running on this thread so LM hooks can attribute calls to it
+    if getattr(dspy.Predict.forward, "_labelled", False):
+        return
+
+    original = dspy.Predict.forward
+
+    @functools.wraps(original)
+    def forward(self, **kwargs):
+        previous = getattr(_local, "label", None)
+        _local.label = predictor_label(self)
+        try:
+            return original(self, **kwargs)
+        finally:
+            _local.label = previous
+
+    forward._labelled = True
+    dspy.Predict.forward = forward
+
+
+def install_metrics(lm, registry):
+    install_predictor_labels()
+
+    def measured_request(inner, prompt, **kwargs):
+        start = time.monotonic()
+        try:
+            response = inner(prompt, **kwargs)
+        except Exception:
+            registry.record(current_label(), request_kwargs(lm, kwargs).get("model"), time.monotonic() - start, error=True)
+            raise
+
+        usage = response.get("usage") or {}
+        registry.record(current_label(), request_kwargs(lm, kwargs).get("model"), time.monotonic() - start, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+        return response
+
+    return wrap_method(lm, "request", measured_request)
+
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def _hedge_pool():
+    # Shared by every hedged client. Abandoned attempts keep a thread until their HTTP call
+    # returns, so it is sized well beyond the API concurrency limit.
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix="lm-hedge")
+        return _hedge_executor
+
+
+def install_hedging(lm, registry, deadlines=None, default_deadline=None, hedge_percentile=0.95, max_hedge_ratio=0.1, min_samples=20):
+    """
+    Wraps request with per-predictor deadlines and hedged requests.
+
+    A call still running after its predictor's hedge_percentile latency (from registry, once it has
+    min_samples calls) gets a duplicate request and the first answer wins. The other attempt is
+    cancelled if it hasn't started and abandoned otherwise: its HTTP call can't be interrupted, but
+    dspy's backoff won't retry it since install_rate_limit raises AttemptAbandoned instead. At most max_hedge_ratio of a predictor's
+    calls are hedged, so a slow API isn't answered with twice the load. A call that has no answer
+    by its deadline raises TimeoutError.
+
+    Install before install_metrics: metrics then see one logical call with the latency the caller
+    experienced, and the hedged, hedge_won and deadline_exceeded counters land in the same series.
+
+    Parameters:
+    - deadlines: Optional {predictor label: seconds}.
+    - default_deadline: Seconds for predictors missing from deadlines, None for no deadline.
+    """
+    deadlines = deadlines or {}
+    lock = threading.Lock()
+    calls = {}
+    hedges = {}
+
+    def may_hedge(label):
+        with lock:
+            if hedges.get(label, 0) + 1 > max_hedge_ratio * calls.get(label, 0):
+                return False
+            hedges[label] = hedges.get(label, 0) + 1
+            return True
+
+    def hedged_request(inner, prompt, **kwargs):
+        if current_stream_sink() is not None:
+            # A streamed answer is consumed as it arrives, a duplicate can't replace it halfway
+            return inner(prompt, **kwargs)
+
+        label = current_label()
+        deadline = deadlines.get(label, default_deadline)
+        with lock:
+            calls[label] = calls.get(label, 0) + 1
+
+        start = time.monotonic()
+        remaining = lambda: None if deadline is None else max(0.0, deadline - (time.monotonic() - start))
+
+        pool = _hedge_pool()
+        abandoned = threading.Event()
+
+        def attempt():
+            _local.abandoned = abandoned
+            try:
+                return inner(prompt, **kwargs)
+            finally:
+                _local.abandoned = None
+
+        pending = {pool.submit(attempt)}
+        hedge = None
+        hedge_after = registry.latency_percentile(label, hedge_percentile, min_samples=min_samples)
+
+        if hedge_after is not None and (deadline is None or hedge_after < deadline):
+            done, _ = wait(pending, timeout=hedge_after)
+            if not done and may_hedge(label):
+                registry.increment(label, "hedged")
+                hedge = pool.submit(attempt)
+                pending.add(hedge)
+
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+
+                abandoned.set()
+                for loser in pending:
+                    loser.cancel()
+                if future is hedge:
+                    registry.increment(label, "hedge_won")
+                return future.result()
+
+        abandoned.set()
+        if error is not None:
+            raise error
+
+        for loser in pending:
+            loser.cancel()
+        registry.increment(label, "deadline_exceeded")
+        raise TimeoutError(f"LM call for {label} got no answer within its {deadline}s deadline")
+
+    return wrap_method(lm, "request", hedged_request)
+
+
+def current_stream_sink():
+    return getattr(_local, "stream_sink", None)
+
+
+def _openai_stream_request(lm, prompt, sink, **kwargs):
+    # dspy's chat request with stream=True, reassembled into the response dict it would have returned.
+    # Streamed responses carry no usage, so tokens are counted locally.
+    import openai
+    from amirbot.ai_tools import token_budget
+
+    raw_kwargs = kwargs
+    kwargs = request_kwargs(lm, kwargs)
+    content = []
+    finish_reason = None
+    for chunk in openai.chat.completions.create(**kwargs, messages=[{"role": "user", "content": prompt}], stream=True):
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            content.append(delta)
+            sink(delta)
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+
+    prompt_tokens = token_budget.count_tokens(prompt)
+    completion_tokens = token_budget.count_tokens("".join(content))
+    response = {
+        "model": kwargs.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(content)}, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+    lm.history.append({"prompt": prompt, "response": response, "kwargs": kwargs, "raw_kwargs": raw_kwargs})
+    return response
+
+
+def install_streaming(lm, registry):
+    """
+    Lets basic_request stream: inside stream_lm_calls(sink) the completion is requested with
+    stream=True and handed to sink(text) as it arrives, while the caller still gets the complete
+    response. Time to first token is recorded per predictor in registry. Install before
+    install_rate_limit so streamed calls are throttled like the rest.
+
+    This runs beneath dspy's backoff, so a stream that fails after sending text is retried from the
+    start. Before the retry, sink.discard() is called if the sink has one, so the text isn't sent
+    twice.
+    """
+    def streaming_request(inner, prompt, **kwargs):
+        sink = current_stream_sink()
+        if sink is None or request_kwargs(lm, kwargs).get("n", 1) > 1:
+            return inner(prompt, **kwargs)
+
+        label = current_label()
+        start = time.monotonic()
+        first_token = []
+
+        def forward(text):
+            if not first_token:
+                first_token.append(time.monotonic() - start)
+                registry.record_first_token(label, first_token[0])
+            sink(text)
+
+        try:
+            if hasattr(lm, "stream_request"):
+                return lm.stream_request(prompt, forward, **kwargs)
+            return _openai_stream_request(lm, prompt, forward, **kwargs)
+        except Exception:
+            if first_token and hasattr(sink, "discard"):
+                sink.discard()
+            raise
+
+    return wrap_method(lm, "basic_request", streaming_request)
+
+
+class _StreamSink:
+    # Feeds an LMStream's queue until a broken stream is retried, see install_streaming
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __call__(self, text):
+        if not self.stream.interrupted:
+            self.stream._queue.put(text)
+
+    def discard(self):
+        # The retry starts the completion over, its text would not continue what was sent
+        self.stream.interrupted = True
+
+
+class LMStream:
+    """
+    Runs fn on a background thread with its LM calls streamed, see stream_lm_calls.
+
+    Iterate it (or async-iterate it) for the text as it arrives; afterwards result holds what fn
+    returned and first_token_seconds the time to the first piece of text. LM calls answered from
+    the cache don't stream, their text only shows up in result.
+
+    If a stream breaks after sending text and the call is retried, the stream stops sending text
+    and interrupted is set: the text so far is then an incomplete draft, and only result is whole.
+    """
+
+    _done = object()
+
+    def __init__(self, fn, *args, **kwargs):
+        import queue
+
+        self.result = None
+        self.error = None
+        self.first_token_seconds = None
+        self.seconds = None
+        self.interrupted = False
+        self._queue = queue.Queue()
+        self._start = time.monotonic()
+
+        config = dict(dspy.settings.config)
+
+        def run():
+            try:
+                with dspy.context(**config), stream_lm_calls(_StreamSink(self)):
+                    self.result = fn(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.seconds = time.monotonic() - self._start
+                self._queue.put(self._done)
+
+        self._thread = threading.Thread(target=run, name="lm-stream", daemon=True)
+        self._thread.start()
+
+    def _next(self):
+        text = self._queue.get()
+        if text is self._done:
+            self._thread.join()
+            if self.error is not None:
+                raise self.error
+            return None
+        if self.first_token_seconds is None:
+            self.first_token_seconds = time.monotonic() - self._start
+        return text
+
+    def __iter__(self):
+        while (text := self._next()) is not None:
+            yield text
+
+    async def __aiter__(self):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        while (text := await loop.run_in_executor(None, self._next)) is not None:
+            yield text
+
+
+@contextlib.contextmanager
+def stream_lm_calls(sink):
+    """LM calls made on this thread inside the block stream their completions to sink(text)."""
+    previous = current_stream_sink()
+    _local.stream_sink = sink
+    try:
+        yield
+    finally:
+        _local.stream_sink = previous
@@ -1,5 +1,9 @@
 import dspy
+import os
 import random
+from concurrent.futures import ThreadPoolExecutor
+from amirbot.dspy_config import gpt4, writer_demo_min_similarity, writer_prompt_budget
+from amirbot.ai_tools import email_cleaning, token_budget
 
 class RemoveSignatures(dspy.Signature):
     email_body = dspy.InputField(desc="The email body to remove signatures from.")
@@ -21,8 +25,21 @@ class InsertVerbalStumblingAndNoise(dspy.Signature):
     # Output is a transcript with verbal stumbling and background noise descriptions added.
     final_transcript = dspy.OutputField(desc="The same transcript with verbal stumbling and background noise descriptions added, NO CHANGES TO CONTENT OTHER THAN ADDITION OF VERBAM STUMBLING AND BACKGROUND NOISE DESCRIPTIONS. Add these on new lines.")
 
+def _in_context(config, fn, *args, **kwargs):
+    # dspy keeps settings per thread and new threads start from the main thread's config, so
+    # re-enter the caller's config (lm, trace, ...) inside the worker.
+    with dspy.context(**config):
+        return fn(*args, **kwargs)
+
 class MakeSyntheticTrainingData(dspy.Module):
-    def __init__(self):
+    def __init__(self, max_self_talk_workers=8, min_clean_confidence=0.7):
+        """
+        Parameters:
+        - min_clean_confidence: Signatures are stripped by ai_tools.email_cleaning when it is at least
+          this confident, only the rest go through the RemoveSignatures LM call.
+        """
+        self.max_self_talk_workers = max_self_talk_workers
+        self.min_clean_confidence = min_clean_confidence
         self.remove_signatures = dspy.Predict(RemoveSignatures, temperature=0.7, max_tokens=1000)
         self.extract_key_points = dspy.Predict(ExtractKeyPoints, temperature=0.7, max_tokens=1000)
         self.add_self_talk = dspy.Predict(AddConversationalSelfTalk, temperature=0.7, max_tokens=1000)
@@ -39,7 +56,11 @@ class MakeSyntheticTrainingData(dspy.Module):
         current_time = 0  # Start the timestamp counter
         transcript = ""
 
-        email_body = self.remove_signatures(email_body=email_body).cleaned_email_body
+        cleaned, confidence = email_cleaning.clean_email(email_body)
+        if confidence >= self.min_clean_confidence:
+            email_body = cleaned
+        else:
+            email_body = self.remove_signatures(email_body=email_cleaning.strip_quotes(email_body)).cleaned_email_body
 
         # logger.debug(f"Cleaned e-mail body: {email_body}")
 
@@ -47,13 +68,16 @@ class MakeSyntheticTrainingData(dspy.Module):
         key_points = self.extract_key_points(email_body=email_body).key_points.split("\n")
         random.shuffle(key_points)
 
-        for point in key_points:
+        # Add conversational self-talk for every point concurrently, results come back in shuffled order
+        config = dict(dspy.settings.config)
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_self_talk_workers, len(key_points)))) as executor:
+            self_talks = list(executor.map(lambda point: _in_context(config, self.add_self_talk, key_points=point).self_talk_transcript, key_points))
+
+        for point, self_talk in zip(key_points, self_talks):
             # Generate and add timestamp for each key point
             timestamp = self.generate_timestamp(current_time)
             transcript += f"{timestamp}\n"  # Append timestamp to the transcript
 
-            # Add conversational self-talk for the point
-            self_talk = self.add_self_talk(key_points=point).self_talk_transcript
             transcript += f"{point}\n"
             transcript += f"{self_talk}\n\n"  # Append self-talk to the transcript
 
@@ -64,4 +88,97 @@ class MakeSyntheticTrainingData(dspy.Module):
         transcript_with_noise = self.insert_stumbling_and_noise(self_talk_transcript=transcript).final_transcript
         # logger.debug(f"Transcript with noise: {transcript_with_noise}")
 
-        return transcript_with_noise
\ No newline at end of file
+        return transcript_with_noise
+
+
+class GenerateEmailFromTranscript(dspy.Signature):
+    notes = dspy.InputField(desc="The notes that should be used when constructing the e-mail.")
+
+    email_body = dspy.OutputField(desc="An e-mail written from the transcript that is well written, captures the key business spoints and important nuance from the notes and is written in the style of the speaker based on their previous e-mails.")
+
+def demo_index_path(model_path):
+    # The retrieval index is saved next to the compiled model, model_write.json -> model_write.demos/
+    return os.path.splitext(model_path)[0] + ".demos"
+
+def bucketer_path(model_path):
+    # model_write.json -> model_write.buckets/, present when per-bucket models were trained
+    return os.path.splitext(model_path)[0] + ".buckets"
+
+def bucket_model_path(model_path, bucket):
+    # model_write.json -> model_write_bucket3.json
+    base, extension = os.path.splitext(model_path)
+    return f"{base}_bucket{bucket}{extension}"
+
+def build_demo_index(examples):
+    """Indexes training examples by their notes, keeping the notes/email pairs as demos."""
+    from amirbot.ai_tools.vector_index import VectorIndex
+
+    examples = list(examples)
+    return VectorIndex.build([e.notes for e in examples], records=[{"notes": e.notes, "email_body": e.email_body} for e in examples])
+
+class WriteEmailFromTranscript(dspy.Module):
+    def __init__(self, demo_index=None, num_demos=3, prompt_budget=writer_prompt_budget, min_demo_similarity=writer_demo_min_similarity):
+        """
+        Parameters:
+        - demo_index: Optional VectorIndex of past notes/email pairs (see build_demo_index). When set,
+          the num_demos pairs whose notes are nearest to the incoming notes are used as demos instead
+          of the compiled ones.
+        - min_demo_similarity: Cosine similarity a pair needs to be retrieved. Notes with no pair
+          that similar keep the compiled demos.
+        - prompt_budget: Optional token budget for the notes plus demos. Notes are truncated to it
+          first and the most relevant demos that fit in the rest are kept.
+        """
+        self.write_email = dspy.Predict(GenerateEmailFromTranscript)
+        self.demo_index = demo_index
+        self.num_demos = num_demos
+        self.prompt_budget = prompt_budget
+        self.min_demo_similarity = min_demo_similarity
+
+    def retrieve_demos(self, notes):
+        return [dspy.Example(**record) for record, _ in self.demo_index.search(notes, k=self.num_demos, min_score=self.min_demo_similarity)]
+
+    def fit_budget(self, notes, demos):
+        notes = token_budget.truncate(notes, self.prompt_budget)
+        remaining = self.prompt_budget - token_budget.count_tokens(notes)
+        return notes, token_budget.fit_demos(demos, remaining, ["notes", "email_body"])
+
+    def forward(self, notes, email_subject, email_to, email_from):
+        # Fall back to the compiled demos when nothing in the index reaches min_demo_similarity
+        demos = (self.retrieve_demos(notes) if self.demo_index is not None else None) or None
+
+        if self.prompt_budget:
+            notes, demos = self.fit_budget(notes, demos if demos is not None else self.write_email.demos)
+
+        with dspy.context(lm=gpt4):
+            if demos is not None:
+                email_body = self.write_email(notes=notes, demos=demos)
+            else:
+                email_body = self.write_email(notes=notes)
+
+        return email_body
+
+    def stream(self, notes, email_subject, email_to, email_from):
+        """
+        Writes the email like forward, streaming the body as the LM produces it.
+
+        Returns:
+        - A dspy_lm.LMStream: iterate it for text pieces as they arrive, then its result is the same
+          Prediction forward returns and first_token_seconds the time to the first piece.
+        """
+        from amirbot import dspy_lm
+
+        return dspy_lm.LMStream(self, notes=notes, email_subject=email_subject, email_to=email_to, email_from=email_from)
+
+def load_writer(model_path):
+    """A WriteEmailFromTranscript loaded from model_path, with its demo index if one was saved."""
+    from amirbot import dspy_lm
+    from amirbot.ai_tools.vector_index import VectorIndex
+
+    demo_index = None
+    if os.path.isdir(demo_index_path(model_path)):
+        demo_index = VectorIndex.load(demo_index_path(model_path))
+
+    model = WriteEmailFromTranscript(demo_index=demo_index)
+    dspy_lm.label_predictors(model)
+    model.load(model_path)
+    return model
@@ -0,0 +1,207 @@
+import json
+import logging
+import math
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import dspy
+from dspy.teleprompt import BootstrapFewShot, LabeledFewShot
+from dspy.teleprompt.teleprompt import Teleprompter
+
+from amirbot.ai_tools import record_log
+
+logger = logging.getLogger(__name__)
+
+
+def _to_dict(item):
+    return item.toDict() if hasattr(item, "toDict") else dict(item)
+
+
+def program_key(program):
+    """Hash of every predictor's name, signature and demos: programs with the same key behave the same."""
+    parts = []
+    for name, predictor in program.named_predictors():
+        demos = [_to_dict(demo) for demo in predictor.demos]
+        parts.append(json.dumps([name, str(predictor.signature), demos], sort_keys=True, default=str))
+    # Demos retrieved per input (WriteEmailFromTranscript.demo_index) and prompt budgets change the behaviour too
+    demo_index = getattr(program, "demo_index", None)
+    if demo_index is not None:
+        parts.append(f"demo_index:{len(demo_index)}:{getattr(program, 'num_demos', None)}")
+    if getattr(program, "prompt_budget", None):
+        parts.append(f"prompt_budget:{program.prompt_budget}")
+    return record_log.content_hash(*parts)
+
+
+def example_key(example):
+    return record_log.content_hash(json.dumps(_to_dict(example), sort_keys=True, default=str))
+
+
+class ScoreMemo:
+    """
+    Thread-safe memo of metric scores keyed by (program_key, example_key). Candidates that end up
+    with the same demos, and the final program re-scored on examples it was already scored on,
+    cost nothing the second time.
+
+    The key does not include the LM, so use one memo per optimization run.
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.scores:
+                self.hits += 1
+                return self.scores[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, score):
+        with self.lock:
+            self.scores[key] = score
+
+
+class SuccessiveHalvingRandomSearch(Teleprompter):
+    """
+    Drop-in replacement for BootstrapFewShotWithRandomSearch that builds the same candidates
+    (zero-shot, labelled-only, unshuffled and num_candidate_programs shuffled bootstraps) but
+    scores them with successive halving: every candidate is scored on a small slice of the
+    validation set, only the best 1/eta move on to a slice eta times larger, and so on until the
+    survivors are scored on the full set. Scores are memoized per (demos, example).
+
+    Judge spend grows roughly with log(num_candidate_programs) instead of linearly.
+
+    Parameters:
+    - min_slice: Validation examples every candidate is scored on in the first round.
+    - eta: Keep the top 1/eta of candidates after each round and grow the slice by eta.
+    - The rest match BootstrapFewShotWithRandomSearch.
+
+    Unlike dspy's version, suggestion/assertion failures are not subtracted from the score; they
+    are already reflected in what the metric sees.
+    """
+
+    def __init__(self, metric, teacher_settings={}, max_bootstrapped_demos=4, max_labeled_demos=16, max_rounds=1, num_candidate_programs=16, num_threads=6, min_slice=4, eta=3, seed=0):
+        self.metric = metric
+        self.teacher_settings = teacher_settings
+        self.max_bootstrapped_demos = max_bootstrapped_demos
+        self.max_labeled_demos = max_labeled_demos
+        self.max_rounds = max_rounds
+        self.num_candidate_programs = num_candidate_programs
+        self.num_threads = num_threads
+        self.min_slice = min_slice
+        self.eta = eta
+        self.seed = seed
+        self.memo = ScoreMemo()
+
+    def candidates(self, student, teacher, trainset):
+        for seed in range(-3, self.num_candidate_programs):
+            trainset2 = list(trainset)
+
+            if seed == -3:
+                # zero-shot
+                program = student.reset_copy()
+            elif seed == -2:
+                # labels only
+                program = LabeledFewShot(k=self.max_labeled_demos).compile(student, trainset=trainset2)
+            else:
+                size = self.max_bootstrapped_demos
+                if seed >= 0:
+                    random.Random(seed).shuffle(trainset2)
+                    size = random.Random(seed).randint(1, self.max_bootstrapped_demos)
+
+                teleprompter = BootstrapFewShot(metric=self.metric, max_bootstrapped_demos=size, max_labeled_demos=self.max_labeled_demos, teacher_settings=self.teacher_settings, max_rounds=self.max_rounds)
+                program = teleprompter.compile(student, teacher=teacher, trainset=trainset2)
+
+            yield seed, program
+
+    def score_one(self, program, program_id, example):
+        key = (program_id, example_key(example))
+        score = self.memo.get(key)
+        if score is None:
+            try:
+                prediction = program(**example.inputs())
+                score = float(self.metric(example, prediction))
+            except Exception as e:
+                logger.warning(f"Error for example in dev set: {e}")
+                score = 0.0
+            self.memo.set(key, score)
+        return score
+
+    def score(self, program, examples, program_id=None, num_threads=None, display_progress=False):
+        """Returns the per-example scores of program on examples, reusing memoized ones."""
+        program_id = program_id or program_key(program)
+        config = dict(dspy.settings.config)
+
+        def run(example):
+            # New threads start from the main thread's dspy config, re-enter the caller's
+            with dspy.context(**config):
+                return self.score_one(program, program_id, example)
+
+        with ThreadPoolExecutor(max_workers=num_threads or self.num_threads) as executor:
+            scores = executor.map(run, examples)
+            if display_progress:
+                from tqdm import tqdm
+                scores = tqdm(scores, total=len(examples), desc="Evaluating")
+            return list(scores)
+
+    def evaluate(self, program, devset, batch=None, num_threads=None, display_progress=False):
+        """
+        Average metric of program on devset as a percentage, like dspy's Evaluate.
+
+        Parameters:
+        - batch: Optional dspy_batch.BatchSession to run the program and metric calls as batch jobs.
+        - num_threads: Threads for the evaluation, the optimizer's num_threads by default.
+        - display_progress: Show a progress bar (interactive runs only, batch rounds are logged).
+        """
+        if batch is not None:
+            program_id = program_key(program)
+            scores = batch.run(list(devset), lambda example: self.score_one(program, program_id, example), desc="evaluation examples")
+        else:
+            scores = self.score(program, list(devset), num_threads=num_threads, display_progress=display_progress)
+        return round(100 * sum(scores) / len(scores), 2) if scores else 0.0
+
+    def compile(self, student, *, teacher=None, trainset, valset=None):
+        valset = list(valset or trainset)
+        # Slices are prefixes, so shuffle once to make every prefix a fair sample
+        random.Random(self.seed).shuffle(valset)
+
+        candidates = []
+        seen = {}
+        for seed, program in self.candidates(student, teacher, trainset):
+            program_id = program_key(program)
+            if program_id in seen:
+                logger.debug(f"Candidate {seed} has the same demos as candidate {seen[program_id]}, skipping")
+                continue
+            seen[program_id] = seed
+            candidates.append({"seed": seed, "program": program, "id": program_id, "subscores": []})
+
+        survivors = candidates
+        size = min(self.min_slice, len(valset))
+        while True:
+            for candidate in survivors:
+                candidate["subscores"] = self.score(candidate["program"], valset[:size], candidate["id"])
+                candidate["score"] = round(100 * sum(candidate["subscores"]) / max(1, size), 2)
+
+            survivors = sorted(survivors, key=lambda c: c["score"], reverse=True)
+            logger.info(f"Scored {len(survivors)} candidates on {size}/{len(valset)} validation examples: {[c['score'] for c in survivors]}")
+
+            if size >= len(valset):
+                break
+
+            survivors = survivors[:max(1, math.ceil(len(survivors) / self.eta))]
+            size = len(valset) if len(survivors) == 1 else min(len(valset), size * self.eta)
+
+        best = survivors[0]
+        logger.info(f"Best candidate is seed {best['seed']} with score {best['score']}, {self.memo.hits} memoized scores reused, {self.memo.misses} computed")
+
+        # Full-set survivors first, then eliminated candidates by their partial score
+        survivor_seeds = {c["seed"] for c in survivors}
+        ranked = survivors + sorted((c for c in candidates if c["seed"] not in survivor_seeds), key=lambda c: (len(c["subscores"]), c["score"]), reverse=True)
+        best_program = best["program"]
+        best_program.candidate_programs = [(c["score"], c["subscores"], c["seed"], c["program"]) for c in ranked]
+
+        return best_program
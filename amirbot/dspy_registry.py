@@ -0,0 +1,74 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from amirbot.dspy_models import bucket_model_path, bucketer_path, load_writer
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """
+    Routes notes to the compiled writer for their e-mail bucket.
+
+    2_train_model.py saves model_write.json (trained on everything), model_write_bucket<n>.json for
+    every bucket with enough examples and the bucketer in model_write.buckets/, fit on the training
+    notes of each bucket. Notes go to the bucket with the nearest centroid; buckets without their
+    own model use the base model. Bucket
+    models are loaded on first use and the least recently used is dropped past max_models.
+
+    Parameters:
+    - model_path: The base compiled model.
+    - max_models: Bucket models kept in memory at once, the base model is always kept.
+    """
+
+    def __init__(self, model_path, max_models=4, loader=load_writer):
+        from amirbot.ai_tools.bucketing import EmailBucketer
+
+        self.model_path = model_path
+        self.max_models = max_models
+        self.loader = loader
+        self.base_model = loader(model_path)
+        self.bucketer = EmailBucketer.load(bucketer_path(model_path)) if os.path.isdir(bucketer_path(model_path)) else None
+        self.models = OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def route(self, notes):
+        """The bucket the notes belong to, or None without a bucketer."""
+        return self.bucketer.predict_one(notes) if self.bucketer is not None else None
+
+    def get(self, bucket):
+        if bucket is None or not os.path.exists(bucket_model_path(self.model_path, bucket)):
+            return self.base_model
+
+        with self.lock:
+            if bucket in self.models:
+                self.models.move_to_end(bucket)
+                return self.models[bucket]
+
+        # Load outside the lock so one slow load doesn't block requests for cached buckets
+        model = self.loader(bucket_model_path(self.model_path, bucket))
+
+        with self.lock:
+            model = self.models.setdefault(bucket, model)
+            self.models.move_to_end(bucket)
+            self.loads += 1
+            while len(self.models) > self.max_models:
+                evicted, _ = self.models.popitem(last=False)
+                self.evictions += 1
+                logger.debug(f"Evicted bucket {evicted} model")
+            return model
+
+    def __call__(self, notes, email_subject="", email_to="", email_from=""):
+        return self.get(self.route(notes))(notes=notes, email_subject=email_subject, email_to=email_to, email_from=email_from)
+
+    def stream(self, notes, email_subject="", email_to="", email_from=""):
+        """Streams the email from the routed model, see WriteEmailFromTranscript.stream."""
+        return self.get(self.route(notes)).stream(notes=notes, email_subject=email_subject, email_to=email_to, email_from=email_from)
+
+    def stats(self):
+        with self.lock:
+            return {"buckets": self.bucketer.num_buckets if self.bucketer is not None else 0, "loaded": list(self.models), "loads": self.loads, "evictions": self.evictions}
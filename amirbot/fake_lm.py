@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+import dspy
+
+logger = logging.getLogger(__name__)
+
+_WORDS = (
+    "strategy team product growth customers roadmap launch funnel engagement revenue pipeline "
+    "metrics retention pricing partners hiring focus quarter goals feedback experiment users "
+    "market sales onboarding priority plan update risk timeline budget design data"
+).split()
+
+_question_number = re.compile(r"(?<!\d)(\d+)\. [A-Z]")
+
+
+def _label(line):
+    return line.split(":", 1)[0].strip()
+
+
+class FakeLM(dspy.OpenAI):
+    """
+    Offline stand-in for the dspy OpenAI client, for benchmarks and dry runs.
+
+    It reads the field layout from the dspy prompt and fills in every remaining output field with
+    deterministic text (seeded by the prompt), sleeps for a latency drawn from a log-normal
+    distribution and reports approximate token usage, so the rest of the request path (cache, rate
+    limiter, metrics) behaves as it would against the API.
+
+    Parameters:
+    - latency_median / latency_sigma: Log-normal latency per call, in seconds.
+    - seconds_per_token: Extra latency per completion token.
+    - responses: Optional {field label: text or fn(final prompt block, rng)} overrides, e.g. {"Assessment Score": "yes"}.
+    - yes_rate: Probability of answering "yes" to judge questions.
+    """
+
+    def __init__(self, model="fake", latency_median=0.0, latency_sigma=0.0, seconds_per_token=0.0, responses=None, yes_rate=0.7, seed=0, **kwargs):
+        super().__init__(model=model, model_type="chat", **kwargs)
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.seconds_per_token = seconds_per_token
+        self.responses = responses or {}
+        self.yes_rate = yes_rate
+        self.seed = seed
+
+        self.calls = 0
+        self._lock = threading.Lock()
+        # Latency is drawn per attempt, not per prompt, so a retried or hedged request can be faster
+        self._latency_rng = random.Random(seed)
+
+    def basic_request(self, prompt, **kwargs):
+        return self.stream_request(prompt, None, **kwargs)
+
+    def stream_request(self, prompt, sink, **kwargs):
+        """
+        basic_request that also hands the first completion to sink(text) word by word, each word
+        after the first-token latency plus seconds_per_token for its tokens. Without a sink the
+        whole latency is slept up front.
+        """
+        raw_kwargs = kwargs
+        kwargs = {**self.kwargs, **kwargs}
+
+        rng = random.Random(hashlib.sha256(f"{self.seed}\0{kwargs.get('temperature')}\0{prompt}".encode("utf-8")).digest())
+        choices = []
+        for i in range(kwargs.get("n", 1)):
+            choices.append({"index": i, "message": {"role": "assistant", "content": self.complete(prompt, rng)}, "finish_reason": "stop"})
+
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = sum(len(c["message"]["content"]) // 4 for c in choices)
+
+        latency = 0.0
+        if self.latency_median:
+            with self._lock:
+                latency = self._latency_rng.lognormvariate(0, self.latency_sigma) * self.latency_median if self.latency_sigma else self.latency_median
+        if sink is None:
+            latency += completion_tokens * self.seconds_per_token
+        if latency:
+            time.sleep(latency)
+
+        if sink is not None:
+            for word in re.findall(r"\s*\S+", choices[0]["message"]["content"]):
+                if self.seconds_per_token:
+                    time.sleep(len(word) // 4 * self.seconds_per_token)
+                sink(word)
+
+        with self._lock:
+            self.calls += 1
+
+        response = {
+            "model": kwargs.get("model"),
+            "choices": choices,
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+        self.history.append({"prompt": prompt, "response": response, "kwargs": kwargs, "raw_kwargs": raw_kwargs})
+        return response
+
+    def complete(self, prompt, rng):
+        # The format block lists every field as "Prefix: description", and dspy ends the prompt with
+        # the prefix of the field it wants next
+        format_block = prompt.split("Follow the following format.", 1)[-1].split("---", 1)[0]
+        labels = [_label(line) for line in format_block.strip().split("\n") if ":" in line]
+        last_block = prompt.rsplit("---", 1)[-1]
+
+        current = _label(prompt.rstrip().split("\n")[-1])
+        if current not in labels:
+            return self.field_value(current, last_block, rng)
+
+        remaining = labels[labels.index(current):]
+        parts = [self.field_value(remaining[0], last_block, rng)]
+        for label in remaining[1:]:
+            parts.append(f"{label}: {self.field_value(label, last_block, rng)}")
+
+        return "\n\n".join(parts)
+
+    def field_value(self, label, last_block, rng):
+        response = self.responses.get(label)
+        if callable(response):
+            return response(last_block, rng)
+        if response is not None:
+            return response
+
+        if label == "Reasoning":
+            return "produce the answer. We look at the inputs carefully."
+        if label == "Assessment Scores":
+            count = max([int(n) for n in _question_number.findall(last_block)] or [1])
+            return "\n".join(f"{i}: {self.yes_no(rng)}" for i in range(1, count + 1))
+        if label.endswith("Score"):
+            return self.yes_no(rng)
+        if label == "Key Points":
+            return "\n".join(self.words(rng, rng.randint(6, 14)) for _ in range(rng.randint(3, 8)))
+
+        # Free text roughly proportional to the input so length-based checks behave
+        length = min(600, max(40, int(len(last_block.split()) * rng.uniform(1.2, 2.5))))
+        return self.words(rng, length)
+
+    def yes_no(self, rng):
+        return "yes" if rng.random() < self.yes_rate else "no"
+
+    def words(self, rng, count):
+        return " ".join(rng.choice(_WORDS) for _ in range(count)).capitalize() + "."
@@ -0,0 +1,125 @@
+"""
+Benchmark of the rule-based signature/quote cleaner (ai_tools.email_cleaning) that lets
+MakeSyntheticTrainingData skip the RemoveSignatures LM call.
+
+    python benchmarks/bench_email_cleaning.py --mailbox mailbox.jsonl --llm-sample 50
+    python benchmarks/bench_email_cleaning.py --fake-lm
+
+Reports cleaner throughput, the share of e-mails handled locally (LM calls avoided) and, on a
+sample of those, agreement with the RemoveSignatures LM call: exact matches after whitespace
+normalization and mean character similarity. Without --mailbox a synthetic mailbox with known
+clean bodies is used and the cleaner is also scored against that ground truth. --fake-lm runs
+offline against FakeLM, which only exercises the code path: its agreement numbers mean nothing.
+"""
+import argparse
+import difflib
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from amirbot.ai_tools import email_cleaning
+
+SIGNATURES = [
+    "\n\nThanks,\nAmir",
+    "\n\nBest,\nAmir Elaguiz\nCEO, Example Inc\n+1 (555) 123-4567\nwww.example.com",
+    "\n\nSent from my iPhone",
+    "\n\n-- \nAmir\nhttps://example.com",
+    "\n\nCheers\n\nSent from my iPhone",
+    "\n\n-Amir",
+    "\n\nAmir",
+    "",
+    "\n\nThanks!\nAmir\n\nP.S. one more thing about the roadmap that I forgot to mention earlier, see the doc for details",
+    "\n\nAmir Elaguiz | Founder\nConfidential: this message is intended only for the named recipient and may contain privileged information",
+]
+QUOTES = ["", "", "\n\nOn Mon, Jan 1, 2024 at 10:00 AM Bob <bob@example.com> wrote:\n> can you send the plan?\n> thanks"]
+
+
+def synthetic_mailbox(num_emails, seed=0):
+    rng = random.Random(seed)
+    words = "we need to focus the team on growth this quarter and make sure the roadmap reflects what customers tell us about pricing onboarding and retention".split()
+    emails = []
+    for _ in range(num_emails):
+        body = "\n\n".join(" ".join(rng.choice(words) for _ in range(rng.randint(8, 25))).capitalize() + "." for _ in range(rng.randint(1, 4)))
+        emails.append({"body": body + rng.choice(SIGNATURES) + rng.choice(QUOTES), "clean_body": body})
+    return emails
+
+
+def normalize(text):
+    return " ".join((text or "").split())
+
+
+def similarity(a, b):
+    return difflib.SequenceMatcher(None, normalize(a), normalize(b)).ratio()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mailbox", help="Mailbox JSONL with a body per line, defaults to a synthetic one")
+    parser.add_argument("--emails", type=int, default=2000, help="Size of the synthetic mailbox")
+    parser.add_argument("--llm-sample", type=int, default=25, help="Locally cleaned e-mails to compare against the LM, 0 to skip")
+    parser.add_argument("--min-confidence", type=float, default=0.7)
+    parser.add_argument("--fake-lm", action="store_true", help="Use the offline FakeLM for the comparison")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    if args.mailbox:
+        with open(args.mailbox) as f:
+            emails = [json.loads(line) for line in f]
+    else:
+        emails = synthetic_mailbox(args.emails)
+
+    start = time.perf_counter()
+    cleaned = [email_cleaning.clean_email(email["body"]) for email in emails]
+    elapsed = time.perf_counter() - start
+
+    local = [i for i, (_, confidence) in enumerate(cleaned) if confidence >= args.min_confidence]
+    results = {
+        "emails": len(emails),
+        "emails_per_sec": round(len(emails) / elapsed, 1),
+        "handled_locally": len(local),
+        "lm_calls_avoided_pct": round(100 * len(local) / len(emails), 1) if emails else None,
+    }
+    print(f"Cleaned {len(emails)} e-mails in {elapsed:.3f}s ({results['emails_per_sec']:.0f} e-mails/s)")
+    print(f"Handled locally at confidence >= {args.min_confidence}: {len(local)} ({results['lm_calls_avoided_pct']}% of RemoveSignatures calls avoided)")
+
+    if "clean_body" in emails[0]:
+        exact = sum(normalize(cleaned[i][0]) == normalize(emails[i]["clean_body"]) for i in local)
+        results["ground_truth_exact_pct"] = round(100 * exact / len(local), 1) if local else None
+        print(f"Locally cleaned e-mails matching the ground truth exactly: {results['ground_truth_exact_pct']}%")
+
+    if args.llm_sample and local:
+        if args.fake_lm:
+            os.environ["AMIRBOT_FAKE_LM"] = "1"
+
+        import dspy
+        from amirbot.dspy_config import turbo
+        from amirbot.dspy_models import RemoveSignatures
+
+        remove_signatures = dspy.Predict(RemoveSignatures, temperature=0.7, max_tokens=1000)
+        sample = random.Random(0).sample(local, min(args.llm_sample, len(local)))
+
+        similarities = []
+        exact = 0
+        with dspy.context(lm=turbo, trace=None):
+            for i in sample:
+                llm_cleaned = remove_signatures(email_body=email_cleaning.strip_quotes(emails[i]["body"])).cleaned_email_body
+                similarities.append(similarity(cleaned[i][0], llm_cleaned))
+                exact += normalize(cleaned[i][0]) == normalize(llm_cleaned)
+
+        results["llm_sample"] = len(sample)
+        results["llm_exact_pct"] = round(100 * exact / len(sample), 1)
+        results["llm_mean_similarity"] = round(sum(similarities) / len(similarities), 3)
+        print(f"Agreement with the LM on {len(sample)} locally cleaned e-mails: {results['llm_exact_pct']}% exact, {results['llm_mean_similarity']} mean similarity" + (" (FakeLM, not meaningful)" if args.fake_lm else ""))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Import-time budget check based on `python -X importtime`.
+
+Each target in import_budget.json is either a module ("amirbot.ai_tools") or a command line run
+from the repo root ("scripts/3_consult_model.py --help"). Its cost is the cumulative import time
+of everything it imports, excluding modules already loaded at interpreter startup (the imports
+of `python -c pass`). Fails if any target is over budget.
+
+    python benchmarks/bench_import_time.py
+    python benchmarks/bench_import_time.py --repeat 5 --json import_times.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "import_budget.json")
+
+
+def top_level_imports(args):
+    """Returns {module: cumulative seconds} for the top-level imports reported by -X importtime."""
+    env = {**os.environ, "PYTHONPATH": ROOT}
+    result = subprocess.run([sys.executable, "-X", "importtime", *args], cwd=ROOT, env=env, capture_output=True, text=True)
+
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented by two spaces per level
+        if not name[1:].startswith(" "):
+            imports[name.strip()] = int(cumulative) / 1e6
+
+    return imports
+
+
+def import_seconds(args, startup_modules):
+    return sum(seconds for name, seconds in top_level_imports(args).items() if name not in startup_modules)
+
+
+def target_args(target):
+    if target.endswith(".py") or ".py " in target:
+        return target.split()
+    return ["-c", f"import {target}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Take the best of this many runs per target")
+    parser.add_argument("--json", help="Write measured seconds per target to this file")
+    args = parser.parse_args()
+
+    with open(BUDGET_PATH) as f:
+        budget = json.load(f)
+
+    startup_modules = set(top_level_imports(["-c", "pass"]))
+
+    results = {}
+    over = []
+    for target, limit in budget.items():
+        seconds = min(import_seconds(target_args(target), startup_modules) for _ in range(args.repeat))
+        results[target] = round(seconds, 4)
+        status = "OK" if seconds <= limit else "OVER"
+        print(f"{status:>4} {target:<50} {seconds * 1000:8.1f} ms (budget {limit * 1000:.0f} ms)")
+        if seconds > limit:
+            over.append(target)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if over:
+        print(f"{len(over)} target(s) over their import-time budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+End-to-end throughput benchmark of the synthesis -> optimization -> writing pipeline against the
+offline FakeLM, so throughput regressions show up without spending API quota.
+
+    python benchmarks/bench_pipeline.py --emails 200 --latency 0.2 --json bench.json
+    python benchmarks/bench_pipeline.py --baseline bench.json --tolerance 0.2
+
+Stages:
+- ingest: get_training_examples over a synthetic mailbox JSONL, building its mailbox index
+- reingest: the same selection again, from the index
+- synthesize: script 1's MakeSyntheticTrainingData over every e-mail with an 8 thread pool
+- optimize: SuccessiveHalvingRandomSearch (the training scripts' optimizer) of WriteEmailFromTranscript with the judge metric
+- write: the compiled WriteEmailFromTranscript over every synthesized example
+
+Reports e-mails/sec, LM calls and prompt tokens per e-mail and peak memory per stage. With --baseline the run
+fails if any stage's throughput drops by more than --tolerance.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_script(name):
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(ROOT, "scripts", f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_corpus(path, num_emails, seed=0):
+    rng = random.Random(seed)
+    words = "we need to focus the team on growth this quarter and make sure the roadmap reflects what customers tell us about pricing onboarding and retention".split()
+
+    with open(path, "w") as f:
+        for i in range(num_emails):
+            paragraphs = ["\n".join(" ".join(rng.choice(words) for _ in range(rng.randint(8, 20))) for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 6))]
+            subject = f"Strategy update {i}" if rng.random() < 0.9 else f"Re: Strategy update {i}"
+            body = "\n\n".join(paragraphs) + "\n\nThanks,\nAmir"
+            f.write(json.dumps({"subject": subject, "body": body, "from": "amir@example.com", "to": "team@example.com"}) + "\n")
+
+
+def lm_calls():
+    from amirbot.dspy_config import turbo, gpt4
+    return turbo.calls + gpt4.calls
+
+
+def prompt_tokens():
+    from amirbot.dspy_config import lm_metrics
+    return sum(series["prompt_tokens"] for series in lm_metrics.snapshot().values())
+
+
+def peak_memory_mb(trace_memory):
+    if trace_memory:
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def run_stage(results, name, items, fn, trace_memory):
+    if trace_memory:
+        tracemalloc.reset_peak()
+
+    calls, tokens = lm_calls(), prompt_tokens()
+    start = time.perf_counter()
+    output = fn()
+    elapsed = time.perf_counter() - start
+    calls, tokens = lm_calls() - calls, prompt_tokens() - tokens
+
+    results[name] = {
+        "items": items,
+        "seconds": round(elapsed, 3),
+        "emails_per_sec": round(items / elapsed, 3) if elapsed else None,
+        "lm_calls": calls,
+        "lm_calls_per_email": round(calls / items, 2) if items else None,
+        "prompt_tokens_per_email": round(tokens / items, 1) if items else None,
+        "peak_memory_mb": round(peak_memory_mb(trace_memory), 1),
+    }
+    print(f"{name:>12}: {items:5d} e-mails in {elapsed:8.2f}s  {results[name]['emails_per_sec'] or 0:8.2f} e-mails/s  {results[name]['lm_calls_per_email'] or 0:6.2f} LM calls/e-mail  {results[name]['prompt_tokens_per_email'] or 0:8.1f} prompt tokens/e-mail  {results[name]['peak_memory_mb']:8.1f} MB peak")
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05, help="Median FakeLM latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--candidates", type=int, default=3, help="num_candidate_programs for the optimizer")
+    parser.add_argument("--prompt-budget", type=int, help="WriteEmailFromTranscript prompt budget in tokens for the write stage")
+    parser.add_argument("--trace-memory", action="store_true", help="Report per-stage tracemalloc peaks instead of process max RSS")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--baseline", help="Results file from a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    os.environ["AMIRBOT_FAKE_LM"] = "1"
+    os.environ["FAKE_LM_LATENCY_MEDIAN"] = str(args.latency)
+    os.environ["FAKE_LM_LATENCY_SIGMA"] = str(args.latency_sigma)
+    os.environ.pop("LM_CACHE_PATH", None)
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    synthesis = load_script("1_generate_synthetic_training")
+    training = load_script("2_train_model")
+
+    import dspy
+    from amirbot.ai_tools import pipeline
+    from amirbot.dspy_optimize import SuccessiveHalvingRandomSearch
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = os.path.join(tmp, "emails.jsonl")
+        write_corpus(corpus, args.emails)
+
+        run_stage(results, "ingest", args.emails, lambda: list(synthesis.get_training_examples(corpus)), args.trace_memory)
+        # Later runs select from the mailbox index the first one built
+        examples = run_stage(results, "reingest", args.emails, lambda: list(synthesis.get_training_examples(corpus)), args.trace_memory)
+
+    model = synthesis.new_model()
+
+    def synthesize():
+        # The synthesis stage of 1_generate_synthetic_training.py, longest e-mails first
+        stages = [pipeline.Stage("synthesize", lambda example: synthesis.process_example(example, model), args.threads)]
+        return list(pipeline.run_pipeline(examples, stages, window=2 * args.threads, priority=lambda example: len(example.email_body)))
+
+    synthesized = run_stage(results, "synthesize", len(examples), synthesize, args.trace_memory)
+
+    training_data = [
+        dspy.Example(notes=e.notes, email_body=e.email_body, email_subject=e.email_subject, email_to=e.email_to, email_from=e.email_from).with_inputs("notes", "email_subject", "email_to", "email_from")
+        for e in synthesized
+    ]
+    split = max(1, len(training_data) // 5)
+    train_set, validate_set = training_data[split:], training_data[:split]
+
+    def optimize():
+        optimizer = SuccessiveHalvingRandomSearch(metric=training.email_style_and_accuracy_score, num_threads=args.threads, num_candidate_programs=args.candidates, max_bootstrapped_demos=3, teacher_settings=dict(lm=training.gpt4))
+        return optimizer.compile(training.WriteEmailFromTranscript(), trainset=train_set, valset=validate_set)
+
+    compiled = run_stage(results, "optimize", len(train_set) + len(validate_set), optimize, args.trace_memory)
+
+    compiled.prompt_budget = args.prompt_budget
+
+    def write():
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            return list(executor.map(lambda e: compiled(notes=e.notes, email_subject=e.email_subject, email_to=e.email_to, email_from=e.email_from), training_data))
+
+    run_stage(results, "write", len(training_data), write, args.trace_memory)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = []
+        for stage, result in results.items():
+            before = baseline.get(stage, {}).get("emails_per_sec")
+            if before and result["emails_per_sec"] is not None and result["emails_per_sec"] < before * (1 - args.tolerance):
+                regressions.append(f"{stage}: {result['emails_per_sec']} e-mails/s vs {before} baseline")
+
+        if regressions:
+            print("Throughput regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import sys
+sys.path.append('.')
+
+from amirbot import ai_tools
+import argparse
+import logging
+from collections import Counter, defaultdict
+
+# Initialize logging
+ai_tools.init_env_logging(".env")
+
+from amirbot.ai_tools.mailbox_index import MailboxIndex
+from amirbot.ai_tools.bucketing import EmailBucketer
+
+logger = logging.getLogger(__name__)
+
+
+def email_texts(email_inputs):
+    # Subject plus body without quoted replies, the same text the training scripts work from. Read
+    # from the mailbox index, which 1_generate_synthetic_training.py reuses
+    for email in MailboxIndex.open(email_inputs).records(columns=("subject",)):
+        yield f"{email['subject']}\n{email['body']}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster the mailbox into e-mail types for per-type training.")
+    parser.add_argument("email_inputs", help="Mailbox JSONL, one {subject, body, to, from} per line")
+    parser.add_argument("bucketer_path", help="Directory to save the bucketer to, pass it to 2_train_model.py")
+    parser.add_argument("--buckets", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    bucketer = EmailBucketer(num_buckets=args.buckets, batch_size=args.batch_size)
+    bucketer.fit(lambda: email_texts(args.email_inputs))
+    bucketer.save(args.bucketer_path)
+
+    # Summarize each bucket by size and a few subjects so the types can be sanity checked
+    sizes = Counter()
+    subjects = defaultdict(list)
+    texts = email_texts(args.email_inputs)
+    while batch := [text for _, text in zip(range(args.batch_size), texts)]:
+        for text, bucket in zip(batch, bucketer.predict(batch)):
+            sizes[bucket] += 1
+            if len(subjects[bucket]) < 5:
+                subjects[bucket].append(text.split("\n", 1)[0])
+
+    for bucket, size in sorted(sizes.items()):
+        logger.info(f"Bucket {bucket}: {size} e-mails, e.g. {subjects[bucket]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,18 +7,25 @@ from amirbot import ai_tools
 ai_tools.init_env_logging(".env")
 
 from tqdm import tqdm
-import pickle
+import argparse
+import contextlib
+import itertools
 import json
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from collections import deque
-import random
+import os
+import socket
+import subprocess
+import time
 import dspy
-from amirbot import dspy_models
+from amirbot import dspy_batch
+from amirbot import dspy_judge
+from amirbot import dspy_lm
+from amirbot.dspy_optimize import SuccessiveHalvingRandomSearch
+from amirbot.ai_tools import near_duplicates, pipeline, record_log, text_metrics, token_budget
+from amirbot.ai_tools.mailbox_index import MailboxIndex
+from amirbot.ai_tools.utils import example_key, hash_fraction
 
-from amirbot.dspy_config import turbo, gpt4
-from dspy.teleprompt import BootstrapFewShotWithRandomSearch, BootstrapFewShot
-from dspy.evaluate import Evaluate
+from amirbot.dspy_config import turbo, gpt4, lm_metrics
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +37,12 @@ class GenerateSyntheticNotesfromEmail2(dspy.Signature):
     input_notes = dspy.InputField(desc="The notes so far")
     synthetic_notes = dspy.OutputField(desc="Synthetic notes expanded to have related ideas that weren't sufficiently relevent to make the final e-mail, additional thoughts and ideas, related metrics and notes to self, and other relevant information that the sender would have considered when drafting the e-mail. Should be twice as long as the input notes.")
 
+# Each expansion of the notes should be at least this much longer than the notes it expands. Shorter
+# ones are resampled up to NOTES_EXPANSION_RETRIES times, a little hotter each time, and the longest
+# is kept
+NOTES_MIN_EXPANSION = 1.5
+NOTES_EXPANSION_RETRIES = 2
+
 class MakeSyntheticTrainingData(dspy.Module):
     def __init__(self):
         self.generate_notes = dspy.ChainOfThought(GenerateSyntheticNotesfromEmail)
@@ -41,29 +54,39 @@ class MakeSyntheticTrainingData(dspy.Module):
 
             for model in [self.generate_notes2]:
                 prev_notes = notes.synthetic_notes
-                notes = model(input_notes=notes.synthetic_notes)
-
-                dspy.Suggest(len(notes.synthetic_notes) > len(prev_notes) * 1.5, "The synthetic notes should be at least 1.5 times longer than the previous notes.")
+                # Checked here rather than with dspy.Suggest: the assertion transform holds dspy's global
+                # settings lock for the whole forward, so synthesis threads would run one at a time
+                candidates = []
+                for attempt in range(NOTES_EXPANSION_RETRIES + 1):
+                    config = {"temperature": turbo.kwargs["temperature"] + 0.1 * attempt} if attempt else {}
+                    candidates.append(model(input_notes=prev_notes, config=config))
+                    if text_metrics.length_ratios([candidates[-1].synthetic_notes], [prev_notes], unit="chars")[0] > NOTES_MIN_EXPANSION:
+                        break
+                notes = max(candidates, key=lambda candidate: len(candidate.synthetic_notes))
 
             return notes
 
+# Only e-mails whose subject contains this are used; set it empty to keep every type of e-mail and
+# let 0_bucket_emails.py / 2_train_model.py split them by type instead
+EMAIL_SUBJECT_FILTER = os.getenv("EMAIL_SUBJECT_FILTER", "strategy")
+
+# Longer bodies are cut to this many tokens (see ai_tools.token_budget) before synthesis
+EMAIL_MAX_TOKENS = int(os.getenv("EMAIL_MAX_TOKENS", "700"))
+
 def get_training_examples(email_inputs):
-    for line in open(email_inputs):
-        email = json.loads(line)
-        email_body = "\n".join(line for line in email['body'].split("\n") if not line.startswith(">"))
-        email_subject = email['subject']
+    # The mailbox is parsed and quote-stripped once into an index beside it, later runs only select from it
+    mailbox = MailboxIndex.open(email_inputs)
+    rows = mailbox.select(subject_contains=EMAIL_SUBJECT_FILTER, replies=False, forwards=False)
+    logger.info(f"Selected {len(rows)} of {len(mailbox)} e-mails from {email_inputs}")
 
-        if "strategy" not in email_subject.lower():
-            continue
-        if email_subject.lower().startswith("re: ") or email_subject.lower().startswith("fwd: ") or "--- forwarded message --- " in email_body:
-            continue
+    for email in mailbox.records(rows):
+        email_subject = email['subject']
+        email_body = email['body']
 
-        parts_body = email_body.split(" ")
-        num_words = len(parts_body)
-        parts_body = parts_body[:500]
+        num_tokens = token_budget.count_tokens(email_body)
+        email_body = token_budget.truncate(email_body, EMAIL_MAX_TOKENS)
 
-        logger.info(f"Processing e-mail: {email_subject} - {num_words} words, truncated to {len(parts_body)} words")
-        email_body = " ".join(parts_body)
+        logger.info(f"Processing e-mail: {email_subject} - {num_tokens} tokens, truncated to {min(num_tokens, EMAIL_MAX_TOKENS)} tokens")
 
         email_to = email['to']
         email_from = email['from']
@@ -71,6 +94,33 @@ def get_training_examples(email_inputs):
 
         yield dspy.Example(email_body=email_body, email_subject=email_subject, email_to=email_to, email_from=email_from, notes="").with_inputs("email_body", "email_subject", "email_from", "email_to")
 
+# Bodies at least this similar (Jaccard over 5-word shingles) are near-duplicates, e.g. templated
+# updates and resends; only the first of each is synthesized and trained on
+EMAIL_DEDUP_THRESHOLD = float(os.getenv("EMAIL_DEDUP_THRESHOLD", "0.8"))
+
+def drop_near_duplicates(examples, duplicates_output):
+    """
+    Streams examples, dropping bodies that near-duplicate an earlier one. Each dropped e-mail is
+    recorded in duplicates_output (a record log) with the key of the e-mail it duplicates.
+    """
+    seen = near_duplicates.NearDuplicateFilter(threshold=EMAIL_DEDUP_THRESHOLD)
+    recorded = record_log.completed_keys(duplicates_output)
+    dropped = 0
+
+    with record_log.RecordLog(duplicates_output) as output:
+        for example in examples:
+            key = example_key(example)
+            representative = seen.add(key, example.email_body)
+            if representative is None:
+                yield example
+                continue
+
+            dropped += 1
+            if key not in recorded:
+                output.append(key, {"representative": representative, "email_subject": example.email_subject})
+
+    logger.info(f"Dropped {dropped} near-duplicate e-mails (Jaccard >= {EMAIL_DEDUP_THRESHOLD}), kept {len(seen)}")
+
 def process_example(example, model):
     if len(example.email_body) > 100:
         try:
@@ -89,95 +139,296 @@ class AssessNotes(dspy.Signature):
     assessment_question = dspy.InputField(desc="A targeted question guiding the evaluation of the generated notes against against the actual e-mail.")
     assessment_score = dspy.OutputField(desc="The evaluator's answer (yes or no) if the evaluated criteria is true.")
 
+class AssessNotesRubric(dspy.Signature):
+    generated_notes = dspy.InputField(desc="The generated notes being evaluated.")
+    actual_email = dspy.InputField(desc="The actual email written by the author, used as a benchmark for evaluating the generated notes.")
+    assessment_questions = dspy.InputField(desc="A numbered list of targeted questions guiding the evaluation of the generated notes against the actual e-mail.")
+    assessment_scores = dspy.OutputField(desc="One line per question, in order, formatted as '<question number>: yes' or '<question number>: no'. Answer every question.")
+
+NOTES_RUBRIC = {
+    # Check if the notes contain all the information from the email and additional context
+    "Completeness": "Are all of the key-points and facts from the actual e-mail present in the notes? Answer 'yes' if they do, otherwise 'no'.",
+
+    # Check if the facts in the notes and the email align
+    "Factual Alignment": "Are all of the key-points and facts from the actual e-mail factually aligned with the notes? Answer 'yes' if there is perfect factual alignment, otherwise 'no'.",
+
+    # Check if the notes are sufficiently detailed compared to the email
+    "Detail Ratio": "Are the notes at least 1.5 to 2 times longer than the actual email, providing an expanded view of the information and context? Answer 'yes' if they are sufficiently detailed, otherwise 'no'.",
+
+    # Check the personal and reflective writing style in the notes
+    "Personal Tone": "Do the notes reflect a personal and reflective writing style, as if explaining the email's content to oneself with added insights and interpretations? Answer 'yes' if the tone is personal and reflective, otherwise 'no'.",
+}
+
+# "batched" asks the whole rubric in one call, "per_question" issues one call per question
+NOTES_JUDGE_MODE = os.getenv("NOTES_JUDGE_MODE", dspy_judge.BATCHED)
+
+# Notes that reproduce less than this share of the e-mail's words can't be complete or factually
+# aligned, so the LM judge is skipped entirely
+NOTES_MIN_WORD_RECALL = 0.2
+
+def local_notes_answers(notes, email_body):
+    """Answers the mechanically checkable rubric questions without an LM call."""
+    answers = {
+        "Detail Ratio": bool(text_metrics.length_ratios([notes], [email_body])[0] >= 1.5),
+    }
+
+    if text_metrics.ngram_recall([notes], [email_body])[0] < NOTES_MIN_WORD_RECALL:
+        answers.update({"Completeness": False, "Factual Alignment": False})
+
+    return answers
+
 def email_notes_comprehensiveness_score(example, pred, trace=None):
     # logger.debug(f"Assessing notes for e-mail: {example} Predicted notes: {pred}")
     try:
-        # Check if the notes contain all the information from the email and additional context
-        completeness = "Are all of the key-points and facts from the actual e-mail present in the notes? Answer 'yes' if they do, otherwise 'no'."
-        
-        # Check if the facts in the notes and the email align
-        factual_alignment = "Are all of the key-points and facts from the actual e-mail factually aligned with the notes? Answer 'yes' if there is perfect factual alignment, otherwise 'no'."
-        
-        # Check if the notes are sufficiently detailed compared to the email
-        detail_ratio = "Are the notes at least 1.5 to 2 times longer than the actual email, providing an expanded view of the information and context? Answer 'yes' if they are sufficiently detailed, otherwise 'no'."
-
-        # Check the personal and reflective writing style in the notes
-        personal_tone = "Do the notes reflect a personal and reflective writing style, as if explaining the email's content to oneself with added insights and interpretations? Answer 'yes' if the tone is personal and reflective, otherwise 'no'."
-
-        with dspy.context(lm=turbo):
-            com_score = dspy.Predict(AssessNotes)(generated_notes=pred.synthetic_notes, actual_email=example.email_body, assessment_question=completeness)
-            fa_score = dspy.Predict(AssessNotes)(generated_notes=pred.synthetic_notes, actual_email=example.email_body, assessment_question=factual_alignment)
-            dr_score = dspy.Predict(AssessNotes)(generated_notes=pred.synthetic_notes, actual_email=example.email_body, assessment_question=detail_ratio)
-            pt_score = dspy.Predict(AssessNotes)(generated_notes=pred.synthetic_notes, actual_email=example.email_body, assessment_question=personal_tone)
+        local_answers = local_notes_answers(pred.synthetic_notes, example.email_body)
+
+        if "Completeness" in local_answers:
+            # Completeness and Factual Alignment already failed, so no judge calls are spent. Personal
+            # Tone is then counted as "no" without asking, which caps these notes at 0.25 (Detail Ratio
+            # only) where asking could give 0.5. A deliberate lower bound: with NOTES_MIN_SCORE above
+            # 0.25, it is this cap and not the judge that rejects them
+            answers = {name: local_answers.get(name, False) for name in NOTES_RUBRIC}
+        else:
+            with dspy.context(lm=turbo):
+                answers = dspy_judge.judge(NOTES_RUBRIC, AssessNotes, AssessNotesRubric, mode=NOTES_JUDGE_MODE, local_answers=local_answers, generated_notes=pred.synthetic_notes, actual_email=example.email_body)
 
         # Convert 'yes' answers to 1, and 'no' answers to 0
-        scores = [(1 if m.assessment_score.split()[0].lower() == 'yes' else 0) for m in [com_score, fa_score, dr_score, pt_score]]
-        # logger.debug(dr_score)
-        # scores = [(1 if m.assessment_score.split()[0].lower() == 'yes' else 0) for m in [dr_score]]
+        scores = [(1 if answer else 0) for answer in answers.values()]
         total_yes = sum(scores)
         
         # Logging for debug purposes
         logging.debug(f"Notes: {pred.synthetic_notes}")
         logging.debug(f"Actual Email: {example.email_body}")
-        logging.info(f"Assessment Results: Completeness = {com_score.assessment_score}, Factual Alignment = {fa_score.assessment_score}, Detail Ratio = {dr_score.assessment_score}, Personal Tone = {pt_score.assessment_score}")
-        # logging.info(f"Detail Ratio = {dr_score.assessment_score}")
+        logging.info("Assessment Results: " + ", ".join(f"{name} = {'yes' if answer else 'no'}" for name, answer in answers.items()))
         score = total_yes / len(scores)
         logging.info(f"Total 'Yes' Responses = {total_yes} - Score = {score}")
 
         return score
-    except:
+    except Exception:
         import traceback
         traceback.print_exc()
         logging.exception(f"Failed to assess notes for e-mail: {example} Predicted notes: {pred}")
         return 0
 
 
-def main():
-    email_inputs = sys.argv[1]
-    training_output = sys.argv[2]
-    model_output = sys.argv[3]
-
-    training_data = list(get_training_examples(email_inputs))
-    random.shuffle(training_data)
+def new_model():
+    model = MakeSyntheticTrainingData()
+    dspy_lm.label_predictors(model)
+    return model
 
-    train_set, validate_set, test_set = ai_tools.split_dataset(training_data, 0.8, 0.1, 0.1)
+def optimize_model(training_data, model_output):
+    # Hash-based split: the same e-mails always land in the same set, so cached LM calls stay reusable
+    train_set, validate_set, test_set = ai_tools.split_dataset(training_data, 0.8, 0.1, 0.1, key=example_key)
     logger.debug(f"Training set size: {len(train_set)}, Validation set size: {len(validate_set)}, Test set size: {len(test_set)}")
 
-    model = MakeSyntheticTrainingData()
-    dspy.assert_transform_module(model)
+    model = new_model()
 
     # example = train_set[0]
     # pred = model(email_body=example.email_body, email_subject=example.email_subject, email_from=example.email_from, email_to=example.email_to)
     # email_notes_comprehensiveness_score(example, pred)
 
-    evaluator = Evaluate(devset=test_set, num_threads=8, display_progress=True, display_table=False, metric=email_notes_comprehensiveness_score)
-    # avg_score = evaluator(model)
+    # Candidates are scored by successive halving with memoized scores, so num_candidate_programs
+    # can grow without a matching growth in judge calls
+    optimizer = SuccessiveHalvingRandomSearch(metric=email_notes_comprehensiveness_score, num_threads=8, num_candidate_programs=3, max_bootstrapped_demos=3, teacher_settings=dict(lm=gpt4))
+    # avg_score = optimizer.evaluate(model, test_set)
     # logging.info(f"BEFORE OPTIMIZATION EVALUATION: {avg_score}%")
 
-    optimizer = BootstrapFewShotWithRandomSearch(metric=email_notes_comprehensiveness_score, num_threads=8, num_candidate_programs=3, max_bootstrapped_demos=3, teacher_settings=dict(lm=gpt4))
     compiled_model = optimizer.compile(model, trainset=train_set, valset=validate_set)
     compiled_model.save(model_output)
 
-    avg_score = evaluator(compiled_model)
+    avg_score = optimizer.evaluate(compiled_model, test_set, batch=dspy_batch.batch_session(f"evaluate-{os.path.splitext(os.path.basename(model_output))[0]}"), num_threads=8, display_progress=True)
     logging.info(f"AFTER OPTIMIZATION EVALUATION: {avg_score}%")
 
-    # with open(training_output, "wb") as f:
-    #     pickle.dump(ready_training, f)
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        future_to_example = {executor.submit(process_example, example, compiled_model): example for example in training_data[:200]}
-
-        ready_training = []
-
-        for future in tqdm(as_completed(future_to_example), total=len(future_to_example), desc="Processing emails"):
-            result = future.result()
-            if result:
-                ready_training.append(result)
-
+    return compiled_model
+
+def shard_path(training_output, shard, shards, suffix=""):
+    # synth.jsonl -> synth.shard002-of-008.jsonl
+    base, extension = os.path.splitext(training_output)
+    return f"{base}.shard{shard:03d}-of-{shards:03d}{suffix}{extension}"
+
+def shard_progress_path(training_output, shard, shards):
+    # synth.jsonl -> synth.shard002-of-008.progress.json, rewritten as the worker goes
+    return os.path.splitext(shard_path(training_output, shard, shards))[0] + ".progress.json"
+
+def shard_of(example, shards):
+    # Stable across runs and hosts, so a restarted worker picks up exactly the same e-mails
+    return int(hash_fraction(example_key(example)) * shards)
+
+def write_progress(path, progress):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({**progress, "host": socket.gethostname(), "pid": os.getpid(), "updated_at": time.time()}, f)
+    os.replace(tmp_path, path)
+
+# Optional quality gate: synthesized notes scoring below this on the notes rubric are kept out of
+# the training output (recorded in <output>.rejected.jsonl instead). Costs one judge call per e-mail.
+# NOTES_MIN_SCORE=0.6
+NOTES_MIN_SCORE = float(os.getenv("NOTES_MIN_SCORE", "0"))
+
+def judge_example(example):
+    example.notes_score = email_notes_comprehensiveness_score(example, dspy.Prediction(synthetic_notes=example.notes))
+    return example
+
+def synthesize(examples, model, training_output, max_emails=None, threads=8, judge_threads=4, progress_path=None, num_duplicates=0, duplicates_output=None):
+    """
+    Synthesizes notes for examples (any iterable, consumed as the pipeline has room) into
+    training_output. E-mails flow through synthesize -> judge (with NOTES_MIN_SCORE) -> write, each
+    stage with its own threads, so memory stays flat whatever the mailbox size.
+    """
+    # training_output is an append-only record log, so a restarted run only synthesizes what is missing
+    rejected_output = os.path.splitext(training_output)[0] + ".rejected.jsonl"
+    done = record_log.completed_keys(training_output)
+    rejected = record_log.completed_keys(rejected_output)
+    pending = (example for example in examples if example_key(example) not in done and example_key(example) not in rejected)
+    if max_emails:
+        pending = itertools.islice(pending, max(0, max_emails - len(done)))
+    logger.info(f"{len(done)} e-mails already synthesized" + (f", at most {max(0, max_emails - len(done))} more" if max_emails else ""))
+
+    progress = {"done": len(done), "failed": 0, "rejected": len(rejected), "finished": False}
+    last_progress = 0
+    # Only the notes model's own calls count towards the cost of synthesizing an e-mail, not the judge's
+    synthesis_labels = {dspy_lm.predictor_label(predictor) for _, predictor in model.named_predictors()}
+    synthesis_calls = lambda: sum(series["calls"] for label, series in lm_metrics.snapshot().items() if label in synthesis_labels)
+    calls_before = synthesis_calls()
+    processed = 0
+
+    batch = dspy_batch.batch_session(f"synthesize-{os.path.splitext(os.path.basename(training_output))[0]}")
+
+    with record_log.RecordLog(training_output) as output, (record_log.RecordLog(rejected_output) if NOTES_MIN_SCORE else contextlib.nullcontext()) as rejected_log:
+        if batch is not None:
+            # All e-mails go through the batch rounds together and are written once the last round is in
+            pending = list(pending)
+            results = batch.run(pending, lambda example: process_example(example, model), desc="e-mails")
+            if NOTES_MIN_SCORE:
+                results = batch.run(results, lambda example: example and judge_example(example), desc="notes")
+        else:
+            # Longest e-mails first within each window, so the slowest syntheses don't end up as the tail
+            stages = [pipeline.Stage("synthesize", lambda example: process_example(example, model) or example.copy(notes=None), threads)]
+            if NOTES_MIN_SCORE:
+                stages.append(pipeline.Stage("judge", lambda example: judge_example(example) if example.notes else example, judge_threads))
+            results = pipeline.run_pipeline(pending, stages, window=2 * threads, priority=lambda example: len(example.email_body))
+
+        for result in tqdm(results, desc="Processing emails"):
+            processed += 1
+            if not result or not result.notes:
+                progress["failed"] += 1
+            elif NOTES_MIN_SCORE and result.notes_score < NOTES_MIN_SCORE:
+                logger.info(f"Rejected notes scoring {result.notes_score} for: {result.email_subject}")
+                rejected_log.append(example_key(result), {"email_subject": result.email_subject, "notes_score": result.notes_score})
+                progress["rejected"] += 1
+            else:
                 logger.debug(f"Processed e-mail: {result.email_body}")
                 logger.info(f"Synthetic notes: {result.notes}")
-                # Save incrementally in the main thread
-                with open(training_output, "wb") as f:
-                    pickle.dump(ready_training, f)
+                output.append(example_key(result), result.toDict())
+                progress["done"] += 1
+
+            if progress_path and time.monotonic() - last_progress > 5:
+                write_progress(progress_path, progress)
+                last_progress = time.monotonic()
+
+    progress["finished"] = True
+    if progress_path:
+        write_progress(progress_path, progress)
+
+    if processed and num_duplicates:
+        calls_per_email = (synthesis_calls() - calls_before) / processed
+        logger.info(f"Near-duplicate elimination saved ~{num_duplicates * calls_per_email:.0f} synthesis LM calls ({num_duplicates} e-mails at {calls_per_email:.1f} calls each, see {duplicates_output})")
+
+def merge_shards(training_output, shards):
+    """Appends every shard's records missing from training_output, the artifact 2_train_model.py reads."""
+    done = record_log.completed_keys(training_output)
+    merged = 0
+
+    with record_log.RecordLog(training_output) as output:
+        for shard in range(shards):
+            path = shard_path(training_output, shard, shards)
+            if os.path.exists(shard_progress_path(training_output, shard, shards)):
+                with open(shard_progress_path(training_output, shard, shards)) as f:
+                    progress = json.load(f)
+                # Progress files written before the pipeline have a pending count instead
+                if not progress.get("finished", not progress.get("pending")):
+                    logger.warning(f"Shard {shard} is incomplete ({progress['done']} done so far, last update from {progress['host']}), merging what it has")
+            elif not os.path.exists(path):
+                logger.warning(f"Shard {shard} has not started, {path} is missing")
+                continue
+
+            for key, record in record_log.read_records(path):
+                if key not in done:
+                    output.append(key, record)
+                    done.add(key)
+                    merged += 1
+
+    logger.info(f"Merged {merged} new e-mails from {shards} shards, {training_output} now has {len(done)}")
+
+def spawn_workers(args):
+    # Each worker gets a slice of the rate limits so together they stay within the key's quota
+    env = dict(os.environ)
+    for name in ("OPENAI_MAX_REQUESTS_PER_MINUTE", "OPENAI_MAX_TOKENS_PER_MINUTE"):
+        if env.get(name):
+            env[name] = str(max(1, int(env[name]) // args.shards))
+
+    command = [sys.executable, sys.argv[0], args.email_inputs, args.training_output, args.model_output, "--shards", str(args.shards), "--threads", str(args.threads), "--judge-threads", str(args.judge_threads)]
+    if args.max_emails is not None:
+        command += ["--max-emails", str(args.max_emails)]
+
+    workers = [subprocess.Popen(command + ["--shard", str(shard)], env=env) for shard in range(args.shards)]
+    failed = [shard for shard, worker in enumerate(workers) if worker.wait() != 0]
+    if failed:
+        logger.error(f"Shards {failed} failed, rerun them with --shard to resume")
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthesize notes for a mailbox, optionally sharded across processes or hosts.")
+    parser.add_argument("email_inputs", help="Mailbox JSONL")
+    parser.add_argument("training_output", help="Record log of synthesized examples, the input of 2_train_model.py")
+    parser.add_argument("model_output", help="Compiled notes model, written by the optimization step and read by shard workers")
+    parser.add_argument("--shards", type=int, default=1, help="Number of shards the mailbox is split into by a stable hash")
+    parser.add_argument("--shard", type=int, help="Run as the worker for this shard, writing its own shard output and progress file")
+    parser.add_argument("--spawn", action="store_true", help="Optimize if needed, run every shard as a local process, then merge")
+    parser.add_argument("--merge", action="store_true", help="Merge the shard outputs into training_output")
+    parser.add_argument("--optimize-only", action="store_true", help="Only optimize and save the notes model, e.g. before starting workers on other hosts")
+    parser.add_argument("--max-emails", type=int, help="Synthesize at most this many e-mails (per shard for workers), 200 by default without sharding")
+    parser.add_argument("--threads", type=int, default=8, help="Synthesis threads, two sequential LM calls per e-mail")
+    parser.add_argument("--judge-threads", type=int, default=4, help="Judge threads with NOTES_MIN_SCORE set, one LM call per e-mail")
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_shards(args.training_output, args.shards)
+        return
+
+    if args.spawn:
+        if not os.path.exists(args.model_output):
+            optimize_model(list(drop_near_duplicates(get_training_examples(args.email_inputs), os.path.splitext(args.training_output)[0] + ".duplicates.jsonl")), args.model_output)
+        spawn_workers(args)
+        merge_shards(args.training_output, args.shards)
+        return
+
+    if args.shard is not None:
+        # Every worker reads the whole mailbox so near-duplicates are resolved the same way on all of them
+        output = shard_path(args.training_output, args.shard, args.shards)
+        duplicates_output = shard_path(args.training_output, args.shard, args.shards, ".duplicates")
+        examples = (e for e in drop_near_duplicates(get_training_examples(args.email_inputs), duplicates_output) if shard_of(e, args.shards) == args.shard)
+
+        model = new_model()
+        model.load(args.model_output)
+
+        synthesize(examples, model, output, args.max_emails, args.threads, args.judge_threads, progress_path=shard_progress_path(args.training_output, args.shard, args.shards))
+        return
+
+    duplicates_output = os.path.splitext(args.training_output)[0] + ".duplicates.jsonl"
+    training_data = list(drop_near_duplicates(get_training_examples(args.email_inputs), duplicates_output))
+    num_duplicates = len(record_log.completed_keys(duplicates_output))
+
+    compiled_model = optimize_model(training_data, args.model_output)
+    if args.optimize_only:
+        return
+
+    max_emails = args.max_emails if args.max_emails is not None else 200
+    if max_emails and len(training_data) > max_emails:
+        # Only the first max_emails e-mails are synthesized, so only the duplicates among those (in
+        # proportion) would have been sent
+        num_duplicates = round(num_duplicates * max_emails / len(training_data))
+
+    synthesize(training_data, compiled_model, args.training_output, max_emails, args.threads, args.judge_threads, num_duplicates=num_duplicates, duplicates_output=duplicates_output)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -3,39 +3,28 @@ sys.path.append('.')
 
 import pickle
 from amirbot import ai_tools
-import json
 import logging
-from collections import deque
-import random
+import os
+from collections import defaultdict
 
 # Initialize logging
 ai_tools.init_env_logging(".env")
 
 import dspy
 from amirbot.dspy_config import turbo, gpt4
+from amirbot.dspy_models import WriteEmailFromTranscript, bucket_model_path, bucketer_path, build_demo_index, demo_index_path
+from amirbot import dspy_batch
+from amirbot import dspy_judge
+from amirbot import dspy_lm
+from amirbot.dspy_optimize import SuccessiveHalvingRandomSearch
+from amirbot.ai_tools import columnar, record_log, text_metrics
+from amirbot.ai_tools.bucketing import EmailBucketer
+from amirbot.ai_tools.utils import example_key
 
 
 logger = logging.getLogger(__name__)
-from dspy.teleprompt import BootstrapFewShotWithRandomSearch, BootstrapFewShot
-from dspy.evaluate import Evaluate
-import random
 
 
-class GenerateEmailFromTranscript(dspy.Signature):
-    notes = dspy.InputField(desc="The notes that should be used when constructing the e-mail.")
-
-    email_body = dspy.OutputField(desc="An e-mail written from the transcript that is well written, captures the key business spoints and important nuance from the notes and is written in the style of the speaker based on their previous e-mails.")
-
-class WriteEmailFromTranscript(dspy.Module):
-    def __init__(self):
-        self.write_email = dspy.Predict(GenerateEmailFromTranscript)
-
-    def forward(self, notes, email_subject, email_to, email_from):
-        with dspy.context(lm=gpt4):
-            email_body = self.write_email(notes=notes)
-
-        return email_body
-
 class AssessEmail(dspy.Signature):
     notes = dspy.InputField(desc="The original notes used as a basis for generating the email.")
     generated_email = dspy.InputField(desc="The AI-generated email intended to reflect the note's content and the author's style. This is the email that is being evaluated.")
@@ -43,36 +32,67 @@ class AssessEmail(dspy.Signature):
     assessment_question = dspy.InputField(desc="A targeted question guiding the evaluation of the generated email against against the actual e-mail.")
     assessment_score = dspy.OutputField(desc="The evaluator's answer (yes or no) if the evaluated criteria is true.")
 
+class AssessEmailRubric(dspy.Signature):
+    notes = dspy.InputField(desc="The original notes used as a basis for generating the email.")
+    generated_email = dspy.InputField(desc="The AI-generated email intended to reflect the note's content and the author's style. This is the email that is being evaluated.")
+    actual_email = dspy.InputField(desc="The actual email written by the author, used as a benchmark for evaluating the generated email's quality and style. The generated email should be compared to this email.")
+    assessment_questions = dspy.InputField(desc="A numbered list of targeted questions guiding the evaluation of the generated email against the actual e-mail.")
+    assessment_scores = dspy.OutputField(desc="One line per question, in order, formatted as '<question number>: yes' or '<question number>: no'. Answer every question.")
+
+EMAIL_RUBRIC = {
+    "Factual Accuracy": "Does the generated email accurately present facts, figures, and key points from the actual email? Answer 'yes' if it does without any errors or omissions, otherwise 'no'.",
+    "Nuance and Context": "Does the generated email capture and convey the nuances, implied meanings, and contextual subtleties of the actual email? Answer 'yes' if it perfectly reflects the subtleties and context of the actual email, otherwise 'no'.",
+    "Stylistic Alignment": "Does the generated email align with the author's typical tone, voice, language, and phraseology as exhibited in the actual email? Answer 'yes' if the generated email is indistinguishable from the author's own writing in the actual email, otherwise 'no'.",
+    "Coherence and Clarity": "Is the generated email coherent and clear in comparison to the actual email? Answer 'yes' if it matches the exceptional organization, logic, and ease of understanding of the actual email, otherwise 'no'.",
+    "Content Length": "Does the generated email adhere to the actual email's length and level of detail? Answer 'yes' if it conveys the message with a similar amount of content, otherwise 'no'.",
+    "Formality and Tone": "Does the generated email match the formality and tone of the actual email? Answer 'yes' if there is a perfect alignment in the level of formality and tone, otherwise 'no'.",
+    "Structural Alignment": "Does the generated email mirror the actual email's structure, including paragraph organization and sentence structure? Answer 'yes' if there is a structural resemblance, otherwise 'no'.",
+    "Detail Appropriateness": "Does the generated email include just the right amount of detail to effectively convey the message, similar to the actual email? Answer 'yes' if the level of detail is appropriate, otherwise 'no'.",
+}
+
+# "batched" asks the whole rubric in one call, "per_question" issues one call per question
+EMAIL_JUDGE_MODE = os.getenv("EMAIL_JUDGE_MODE", dspy_judge.BATCHED)
+
+# A generated email within this length ratio of the actual email "adheres to its length"
+EMAIL_LENGTH_RATIO_RANGE = (0.67, 1.5)
+# Below this share of the actual email's key facts (figures, names) the email can't be accurate
+EMAIL_MIN_KEY_FACT_RECALL = 0.1
+
+def local_email_answers(generated_email, actual_email):
+    """Answers the mechanically checkable rubric questions without an LM call."""
+    low, high = EMAIL_LENGTH_RATIO_RANGE
+    ratio = text_metrics.length_ratios([generated_email], [actual_email])[0]
+    answers = {
+        "Content Length": bool(low <= ratio <= high),
+    }
+
+    if not (generated_email or "").strip() or text_metrics.key_fact_recall([generated_email], [actual_email])[0] < EMAIL_MIN_KEY_FACT_RECALL:
+        answers["Factual Accuracy"] = False
+
+    return answers
+
 def email_style_and_accuracy_score(example, pred, trace=None):
     try:
-        factual_accuracy = "Does the generated email accurately present facts, figures, and key points from the actual email? Answer 'yes' if it does without any errors or omissions, otherwise 'no'."
-        nuance_context = "Does the generated email capture and convey the nuances, implied meanings, and contextual subtleties of the actual email? Answer 'yes' if it perfectly reflects the subtleties and context of the actual email, otherwise 'no'."
-        stylistic_alignment = "Does the generated email align with the author's typical tone, voice, language, and phraseology as exhibited in the actual email? Answer 'yes' if the generated email is indistinguishable from the author's own writing in the actual email, otherwise 'no'."
-        coherence_clarity = "Is the generated email coherent and clear in comparison to the actual email? Answer 'yes' if it matches the exceptional organization, logic, and ease of understanding of the actual email, otherwise 'no'."
-        content_length = "Does the generated email adhere to the actual email's length and level of detail? Answer 'yes' if it conveys the message with a similar amount of content, otherwise 'no'."
-        formality_tone = "Does the generated email match the formality and tone of the actual email? Answer 'yes' if there is a perfect alignment in the level of formality and tone, otherwise 'no'."
-        structural_alignment = "Does the generated email mirror the actual email's structure, including paragraph organization and sentence structure? Answer 'yes' if there is a structural resemblance, otherwise 'no'."
-        detail_appropriateness = "Does the generated email include just the right amount of detail to effectively convey the message, similar to the actual email? Answer 'yes' if the level of detail is appropriate, otherwise 'no'."
-
-        with dspy.context(lm=turbo):
-            fa_score = dspy.Predict(AssessEmail)(notes=example.notes, generated_email=pred.email_body, actual_email=example.email_body, assessment_question=factual_accuracy)
-            nc_score = dspy.Predict(AssessEmail)(notes=example.notes, generated_email=pred.email_body, actual_email=example.email_body, assessment_question=nuance_context)
-            sa_score = dspy.Predict(AssessEmail)(notes=example.notes, generated_email=pred.email_body, actual_email=example.email_body, assessment_question=stylistic_alignment)
-            cc_score = dspy.Predict(AssessEmail)(notes=example.notes, generated_email=pred.email_body, actual_email=example.email_body, assessment_question=coherence_clarity)
-            cl_score = dspy.Predict(AssessEmail)(notes=example.notes, generated_email=pred.email_body, actual_email=example.email_body, assessment_question=content_length)
-            ft_score = dspy.Predict(AssessEmail)(notes=example.notes, generated_email=pred.email_body, actual_email=example.email_body, assessment_question=formality_tone)
-            stra_score = dspy.Predict(AssessEmail)(notes=example.notes, generated_email=pred.email_body, actual_email=example.email_body, assessment_question=structural_alignment)
-            da_score = dspy.Predict(AssessEmail)(notes=example.notes, generated_email=pred.email_body, actual_email=example.email_body, assessment_question=detail_appropriateness)
+        local_answers = local_email_answers(pred.email_body, example.email_body)
+
+        if "Factual Accuracy" in local_answers:
+            # A cheap check already failed, don't spend judge calls on an email that misses the facts.
+            # Deliberately a lower bound: the questions left unasked (the style questions too) count
+            # as "no", so such an email scores at most its local answers instead of being measured
+            answers = {name: local_answers.get(name, False) for name in EMAIL_RUBRIC}
+        else:
+            with dspy.context(lm=turbo):
+                answers = dspy_judge.judge(EMAIL_RUBRIC, AssessEmail, AssessEmailRubric, mode=EMAIL_JUDGE_MODE, local_answers=local_answers, notes=example.notes, generated_email=pred.email_body, actual_email=example.email_body)
 
         # Convert 'yes' answers to 1, and 'no' answers to 0
-        scores = [(1 if m.assessment_score.split()[0].lower() == 'yes' else 0) for m in [fa_score, nc_score, sa_score, cc_score, cl_score, ft_score, stra_score, da_score]]
+        scores = [(1 if answer else 0) for answer in answers.values()]
         total_yes = sum(scores)
         
         # Logging for debug purposes
         logging.debug(f"Notes: {example.notes}")
         logging.debug(f"Actual Email: {example.email_body}")
         logging.debug(f"Generated Email: {pred.email_body}")
-        logging.debug(f"Assessment Results: Factual Accuracy = {fa_score.assessment_score}, Nuance and Context = {nc_score.assessment_score}, Stylistic Alignment = {sa_score.assessment_score}, Coherence and Clarity = {cc_score.assessment_score}, Content Length = {cl_score.assessment_score}, Formality and Tone = {ft_score.assessment_score}, Structural Alignment = {stra_score.assessment_score}, Detail Appropriateness = {da_score.assessment_score}")
+        logging.debug("Assessment Results: " + ", ".join(f"{name} = {'yes' if answer else 'no'}" for name, answer in answers.items()))
         logging.debug(f"Total 'Yes' Responses = {total_yes}")
 
         return total_yes / len(scores)
@@ -83,29 +103,56 @@ def email_style_and_accuracy_score(example, pred, trace=None):
         logging.exception(f"Failed to evaluate the generated email: {e}")
 
 
-def main():
-    training_data_file = sys.argv[1]
-    model_path = sys.argv[2]
 
-    with open(training_data_file, "rb") as f:
-        _training_data = pickle.load(f)
+TRAINING_COLUMNS = ["notes", "email_body", "email_subject", "email_to", "email_from"]
+INPUT_FIELDS = ["notes", "email_subject", "email_to", "email_from"]
+
+
+def training_table(training_data_file):
+    """
+    Path of the Parquet training table for training_data_file, converting it the first time.
 
+    The record log of 1_generate_synthetic_training.py and legacy pickles of dspy.Example are both
+    converted to a .parquet beside them, redone only when the source is newer.
+    """
+    if training_data_file.endswith(".parquet"):
+        return training_data_file
 
-    training_data = []
-    for example in _training_data:
-        training_data.append(
-            dspy.Example(
-                notes=example.notes,
-                email_body=example.email_body,
-                email_subject=example.email_subject,
-                email_to=example.email_to,
-                email_from=example.email_from
-            ).with_inputs("notes", "email_subject", "email_to", "email_from")
-        )
+    table_path = os.path.splitext(training_data_file)[0] + ".parquet"
+    if os.path.exists(table_path) and os.path.getmtime(table_path) >= os.path.getmtime(training_data_file):
+        return table_path
 
-    random.shuffle(training_data)
+    if training_data_file.endswith((".pkl", ".pickle")):
+        # Legacy output of 1_generate_synthetic_training.py, a pickled list of dspy.Example
+        with open(training_data_file, "rb") as f:
+            records = (example.toDict() for example in pickle.load(f))
+            num_rows = columnar.write_table(table_path, records, TRAINING_COLUMNS)
+    else:
+        records = (record for _, record in record_log.read_records(training_data_file))
+        num_rows = columnar.write_table(table_path, records, TRAINING_COLUMNS)
 
-    train_set, validate_set, test_set = ai_tools.split_dataset(training_data, 0.8, 0.1, 0.1)
+    logger.info(f"Converted {num_rows} training examples from {training_data_file} to {table_path}")
+    return table_path
+
+
+def load_training_examples(table_path, columns=None):
+    """Yields the examples of a training table as dspy.Example, reading only the given columns."""
+    for record in columnar.ColumnarReader(table_path, columns=columns):
+        yield dspy.Example(**record).with_inputs(*[field for field in INPUT_FIELDS if field in record])
+
+
+# Buckets with fewer training e-mails than this use the model trained on everything
+MIN_BUCKET_EXAMPLES = 30
+
+
+def bucket_text(example):
+    # Same text 0_bucket_emails.py clusters on, example can be a dspy.Example or a table row
+    return f"{example['email_subject']}\n{example['email_body']}"
+
+
+def train_model(training_data, model_path, stratify=None):
+    # Hash-based split: the same e-mails always land in the same set, so cached LM calls stay reusable
+    train_set, validate_set, test_set = ai_tools.split_dataset(training_data, 0.8, 0.1, 0.1, key=example_key, stratify=stratify)
     # train_set = _train_set[:20]
     # test_set = _test_set[:5]
     # validate_set = _validate_set[:5]
@@ -113,17 +160,68 @@ def main():
     logger.debug(f"Training set size: {len(train_set)}, Validation set size: {len(validate_set)}, Test set size: {len(test_set)}")
 
     model = WriteEmailFromTranscript()
+    dspy_lm.label_predictors(model)
 
-    evaluator = Evaluate(devset=test_set, num_threads=4, display_progress=True, display_table=False, metric=email_style_and_accuracy_score)
-    # avg_score = evaluator(model)
+    # Candidates are scored by successive halving with memoized scores, so num_candidate_programs
+    # can grow without a matching growth in judge calls
+    optimizer = SuccessiveHalvingRandomSearch(metric=email_style_and_accuracy_score, num_threads=8, num_candidate_programs=3, max_bootstrapped_demos=3, teacher_settings=dict(lm=gpt4))
+    # avg_score = optimizer.evaluate(model, test_set)
     # logging.info(f"BEFORE OPTIMIZATION EVALUATION: {avg_score}%")
 
-    optimizer = BootstrapFewShotWithRandomSearch(metric=email_style_and_accuracy_score, num_threads=8, num_candidate_programs=3, max_bootstrapped_demos=3, teacher_settings=dict(lm=gpt4))
     compiled_model = optimizer.compile(model, trainset=train_set, valset=validate_set)
+
+    # At inference the writer uses the training pairs nearest to the incoming notes as demos. Saved
+    # before the model, whose change is what makes 4_serve_model.py reload
+    demo_index = build_demo_index(train_set)
+    demo_index.save(demo_index_path(model_path))
+    compiled_model.demo_index = demo_index
+    logger.info(f"Saved demo index of {len(demo_index)} examples to {demo_index_path(model_path)}")
+
     compiled_model.save(model_path)
 
-    avg_score = evaluator(compiled_model)
-    logging.info(f"AFTER OPTIMIZATION EVALUATION: {avg_score}%")
+    avg_score = optimizer.evaluate(compiled_model, test_set, batch=dspy_batch.batch_session(f"evaluate-{os.path.splitext(os.path.basename(model_path))[0]}"), num_threads=4, display_progress=True)
+    logging.info(f"AFTER OPTIMIZATION EVALUATION ({model_path}): {avg_score}%")
+
+
+def main():
+    training_data_file = training_table(sys.argv[1])
+    model_path = sys.argv[2]
+    # Optional output of 0_bucket_emails.py, also trains one model per e-mail bucket
+    bucketer_input = sys.argv[3] if len(sys.argv) > 3 else None
+
+    training_data = list(load_training_examples(training_data_file))
+
+    if not bucketer_input:
+        train_model(training_data, model_path)
+        return
+
+    bucketer = EmailBucketer.load(bucketer_input)
+    bucket_rows = columnar.ColumnarReader(training_data_file, columns=["email_subject", "email_body"])
+    buckets = dict(zip(map(example_key, training_data), bucketer.predict([bucket_text(row) for row in bucket_rows]).tolist()))
+
+    train_model(training_data, model_path, stratify=lambda e: buckets[example_key(e)])
+
+    by_bucket = defaultdict(list)
+    for example in training_data:
+        by_bucket[buckets[example_key(example)]].append(example)
+
+    for bucket in range(bucketer.num_buckets):
+        path = bucket_model_path(model_path, bucket)
+        if len(by_bucket[bucket]) >= MIN_BUCKET_EXAMPLES:
+            logger.info(f"Training bucket {bucket} on {len(by_bucket[bucket])} e-mails")
+            train_model(by_bucket[bucket], path)
+        else:
+            logger.info(f"Bucket {bucket} has {len(by_bucket[bucket])} e-mails, it will use the base model")
+            # Don't leave a model from an earlier bucketing behind
+            if os.path.exists(path):
+                os.remove(path)
+
+    # The server routes on notes, not e-mails, so the saved bucketer is refit to put each training
+    # example's notes in its e-mail's bucket. Saved last: the registry only routes to bucket models
+    # once the bucketer sits beside the model
+    router = EmailBucketer(num_buckets=bucketer.num_buckets, dims=bucketer.dims, batch_size=bucketer.batch_size)
+    router.fit_labels([example.notes for example in training_data], [buckets[example_key(example)] for example in training_data])
+    router.save(bucketer_path(model_path))
     
 
 if __name__ == "__main__":
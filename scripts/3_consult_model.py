@@ -1,61 +1,231 @@
 import sys
 sys.path.append('.')
 
-import pickle
-from amirbot import ai_tools
+import argparse
+import http.client
 import json
 import logging
-from collections import deque
-import random
+import os
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+from amirbot import ai_tools
 
 # Initialize logging
 ai_tools.init_env_logging(".env")
 
-import dspy
-from amirbot.dspy_config import turbo, gpt4
-
+# dspy, the compiled model and the LM clients are imported inside the functions that need them, so
+# --help and --server (which talks to scripts/4_serve_model.py) start without loading dspy
 
 logger = logging.getLogger(__name__)
-from dspy.teleprompt import BootstrapFewShotWithRandomSearch, BootstrapFewShot
-from dspy.evaluate import Evaluate
-import random
 
 
-class GenerateEmailFromTranscript(dspy.Signature):
-    notes = dspy.InputField(desc="The notes that should be used when constructing the e-mail.")
+def read_batch_inputs(input_path):
+    """Yields (id, request) for every notes file in a directory or every line of a JSONL file."""
+    if os.path.isdir(input_path):
+        for name in sorted(os.listdir(input_path)):
+            path = os.path.join(input_path, name)
+            if os.path.isfile(path):
+                with open(path) as f:
+                    yield name, {"notes": f.read()}
+    else:
+        with open(input_path) as f:
+            for i, line in enumerate(f):
+                if line.strip():
+                    request = json.loads(line)
+                    yield request.get("id", str(i)), request
 
-    email_body = dspy.OutputField(desc="An e-mail written from the transcript that is well written, captures the key business spoints and important nuance from the notes and is written in the style of the speaker based on their previous e-mails.")
 
-class WriteEmailFromTranscript(dspy.Module):
-    def __init__(self):
-        self.write_email = dspy.Predict(GenerateEmailFromTranscript)
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=300):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
 
-    def forward(self, notes, email_subject, email_to, email_from):
-        with dspy.context(lm=gpt4):
-            email_body = self.write_email(notes=notes)
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
 
-        return email_body
 
+def server_writer(server):
+    """Returns a write function that posts to a running 4_serve_model.py (http://host:port or unix:/path)."""
+    def write(request_id, request):
+        start = time.monotonic()
+        if server.startswith("unix:"):
+            conn = UnixHTTPConnection(server[len("unix:"):])
+        else:
+            url = urlparse(server)
+            conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=300)
 
-def main():
-    model_path = sys.argv[1]
-    input_path = sys.argv[2]
+        try:
+            conn.request("POST", "/email", body=json.dumps(request), headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            payload = json.loads(response.read())
+        finally:
+            conn.close()
+
+        if response.status != 200:
+            raise Exception(f"Server returned {response.status}: {payload.get('error')}")
+
+        return {"id": request_id, "notes": request["notes"], "email_body": payload["email_body"], "latency_seconds": time.monotonic() - start}
+
+    return write
+
+
+def model_writer(model):
+    import dspy
 
+    def write(request_id, request):
+        start = time.monotonic()
+        # No trace: batch runs are long and the global trace list would grow with every call
+        with dspy.context(trace=None):
+            email = model(notes=request["notes"], email_subject=request.get("email_subject", ""), email_to=request.get("email_to", ""), email_from=request.get("email_from", ""))
+        return {"id": request_id, "notes": request["notes"], "email_body": email.email_body, "latency_seconds": time.monotonic() - start}
+
+    return write
+
+
+def load_model(model_path=None):
+    from amirbot import dspy_lm
+    from amirbot.dspy_models import WriteEmailFromTranscript
+    from amirbot.dspy_registry import ModelRegistry
+
+    if model_path:
+        # Routes to per-bucket models when 2_train_model.py trained them, else the single model
+        return ModelRegistry(model_path)
 
     model = WriteEmailFromTranscript()
+    dspy_lm.label_predictors(model)
+    return model
+
+
+def print_stream(stream):
+    # Prints the email as the LM writes it, the final Prediction is the parsed, authoritative body
+    for text in stream:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    if stream.first_token_seconds is None:
+        # Answered from the LM cache, nothing was streamed
+        sys.stdout.write(stream.result.email_body)
+    elif stream.interrupted:
+        # The stream broke off and the call was retried, what was printed is an unfinished draft
+        sys.stdout.write(f"\n\n[stream interrupted, complete email follows]\n{stream.result.email_body}")
+    sys.stdout.write("\n")
+    sys.stdout.flush()
+
+    first_token = f"first text after {stream.first_token_seconds:.2f}s, " if stream.first_token_seconds is not None else ""
+    logger.info(f"Generated email in {stream.seconds:.2f}s ({first_token}{len(stream.result.email_body)} characters)")
+    return stream.result
+
+
+def run_batch(write, input_path, output_path, concurrency, ordered):
+    from amirbot.ai_tools import record_log
+    from tqdm import tqdm
+
+    done = record_log.completed_keys(output_path)
+
+    inputs = []
+    for request_id, request in read_batch_inputs(input_path):
+        key = record_log.content_hash(request_id, request["notes"], request.get("email_subject", ""), request.get("email_to", ""), request.get("email_from", ""))
+        if key not in done:
+            inputs.append((key, request_id, request))
+
+    logger.info(f"{len(done)} emails already written, {len(inputs)} remaining")
+
+    latencies = []
+    failed = 0
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, record_log.RecordLog(output_path) as output, tqdm(total=len(inputs), desc="Writing emails") as progress:
+        # Submit a bounded window of work; in ordered mode completed results wait in `finished` until
+        # everything before them has been written, and count against the window so one stalled
+        # request can't let them pile up
+        pending = {}
+        finished = {}
+        next_to_write = 0
+        next_to_submit = 0
+
+        while next_to_write < len(inputs):
+            while next_to_submit < len(inputs) and len(pending) + len(finished) < concurrency * 2:
+                _, request_id, request = inputs[next_to_submit]
+                pending[executor.submit(write, request_id, request)] = next_to_submit
+                next_to_submit += 1
+
+            completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                idx = pending.pop(future)
+                try:
+                    finished[idx] = future.result()
+                except Exception:
+                    logger.exception(f"Failed to write email for {inputs[idx][1]}")
+                    finished[idx] = None
+
+            writable = sorted(finished) if not ordered else []
+            while ordered and next_to_write + len(writable) in finished:
+                writable.append(next_to_write + len(writable))
+
+            for idx in writable:
+                result = finished.pop(idx)
+                next_to_write += 1
+                progress.update(1)
+                if result is None:
+                    failed += 1
+                    continue
+                latencies.append(result["latency_seconds"])
+                output.append(inputs[idx][0], result)
+
+    elapsed = time.monotonic() - start
+    latencies.sort()
+    if latencies:
+        logger.info(f"Wrote {len(latencies)} emails ({failed} failed) in {elapsed:.1f}s: {len(latencies) / elapsed:.2f} emails/s, latency p50 {latencies[len(latencies) // 2]:.2f}s p95 {latencies[int(len(latencies) * 0.95)]:.2f}s")
+    else:
+        logger.info(f"Nothing written ({failed} failed)")
+
 
-    with open(input_path) as f:
+def main():
+    parser = argparse.ArgumentParser(description="Write emails from notes with the compiled model.")
+    parser.add_argument("model_path", help="Compiled model, ignored with --server")
+    parser.add_argument("input_path", help="A notes file, or for batch mode a directory of notes files or a JSONL of {id, notes, ...}")
+    parser.add_argument("output_path", nargs="?", help="Batch mode: JSONL to stream results to; reruns skip inputs already in it")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--ordered", action="store_true", help="Batch mode: write results in input order")
+    parser.add_argument("--no-stream", action="store_true", help="Single mode: log each email once it is complete instead of printing it as it is written")
+    parser.add_argument("--server", default=os.getenv("AMIRBOT_SERVER"), help="Use a running 4_serve_model.py, e.g. http://127.0.0.1:8765 or unix:/tmp/amirbot.sock")
+    args = parser.parse_args()
+
+    if args.output_path:
+        write = server_writer(args.server) if args.server else model_writer(load_model(args.model_path))
+        run_batch(write, args.input_path, args.output_path, args.concurrency, args.ordered)
+        return
+
+    with open(args.input_path) as f:
         notes = f.read()
 
     logger.info(f"Writing email for notes: {notes}")
-    email = model(notes=notes, email_subject="Test", email_to="", email_from="")
 
-    logger.info(f"Generated email unoptimized: {email.email_body}")
+    if args.server:
+        email = server_writer(args.server)(args.input_path, {"notes": notes, "email_subject": "Test"})
+        logger.info(f"Generated email optimized: {email['email_body']}")
+        return
+
+    if args.no_stream:
+        model = load_model()
+        email = model(notes=notes, email_subject="Test", email_to="", email_from="")
+
+        logger.info(f"Generated email unoptimized: {email.email_body}")
+
+        model = load_model(args.model_path)
+        email = model(notes=notes, email_subject="Test", email_to="", email_from="")
+        logger.info(f"Generated email optimized: {email.email_body}")
+        return
 
-    model.load(model_path)
-    email = model(notes=notes, email_subject="Test", email_to="", email_from="")
-    logger.info(f"Generated email optimized: {email.email_body}")
+    for name, model in (("unoptimized", load_model()), ("optimized", load_model(args.model_path))):
+        print(f"--- Generated email {name} ---", flush=True)
+        print_stream(model.stream(notes=notes, email_subject="Test", email_to="", email_from=""))
     
 
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file
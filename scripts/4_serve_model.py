@@ -0,0 +1,182 @@
+import sys
+sys.path.append('.')
+
+from amirbot import ai_tools
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+
+# Initialize logging
+ai_tools.init_env_logging(".env")
+
+import dspy
+from amirbot.dspy_config import lm_metrics
+from amirbot.dspy_models import bucketer_path, demo_index_path
+from amirbot.dspy_registry import ModelRegistry
+from amirbot.ai_tools.lm_metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledModel:
+    """
+    Holds the compiled writers (a ModelRegistry routing to per-bucket models) and swaps in a freshly
+    loaded set whenever the model files change on disk. In-flight requests keep using the set they
+    started with.
+    """
+
+    def __init__(self, model_path, reload_interval=2.0, max_models=4):
+        self.model_path = model_path
+        self.reload_interval = reload_interval
+        self.max_models = max_models
+        self.model = None
+        self.mtime = None
+        self.loaded_at = None
+        self.reloads = 0
+        self.load()
+
+    def current_mtime(self):
+        # Retraining with buckets rewrites the bucketer last, so a change to either means a new model set.
+        # The demo index is watched too (records.json is the last file its save replaces)
+        mtimes = [os.stat(self.model_path).st_mtime]
+        for path in [os.path.join(bucketer_path(self.model_path), "centroids.npy"), os.path.join(demo_index_path(self.model_path), "records.json")]:
+            if os.path.exists(path):
+                mtimes.append(os.stat(path).st_mtime)
+        return max(mtimes)
+
+    def load(self):
+        mtime = self.current_mtime()
+        model = ModelRegistry(self.model_path, max_models=self.max_models)
+
+        self.model, self.mtime, self.loaded_at = model, mtime, time.time()
+        logger.info(f"Loaded compiled model from {self.model_path}" + (f" with {model.bucketer.num_buckets} buckets" if model.bucketer is not None else ""))
+
+    def watch(self):
+        def run():
+            while True:
+                time.sleep(self.reload_interval)
+                try:
+                    if self.current_mtime() != self.mtime:
+                        self.load()
+                        self.reloads += 1
+                except Exception:
+                    # Keep serving the previous model, e.g. while the file is being rewritten
+                    logger.exception(f"Failed to reload {self.model_path}")
+
+        threading.Thread(target=run, name="model-reload", daemon=True).start()
+
+
+class EmailRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    compiled = None
+    request_metrics = None
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {
+                "status": "ok",
+                "model_path": self.compiled.model_path,
+                "model_loaded_at": self.compiled.loaded_at,
+                "model_reloads": self.compiled.reloads,
+                "models": self.compiled.model.stats(),
+                "requests": self.request_metrics.snapshot(),
+                "lm": lm_metrics.snapshot(),
+            })
+        elif self.path == "/metrics":
+            body = lm_metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/email":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        start = time.monotonic()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            notes = request["notes"]
+        except Exception as e:
+            self.send_json(400, {"error": f"Expected a JSON body with a notes field: {e}"})
+            return
+
+        try:
+            # No trace: the process is long lived and the global trace list would grow forever
+            with dspy.context(trace=None):
+                email = self.compiled.model(notes=notes, email_subject=request.get("email_subject", ""), email_to=request.get("email_to", ""), email_from=request.get("email_from", ""))
+        except Exception as e:
+            logger.exception("Failed to write email")
+            self.request_metrics.record("email", None, time.monotonic() - start, error=True)
+            self.send_json(500, {"error": str(e)})
+            return
+
+        latency = time.monotonic() - start
+        self.request_metrics.record("email", None, latency)
+        self.send_json(200, {"email_body": email.email_body, "latency_seconds": latency})
+
+
+class UnixHTTPServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("unix", 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the compiled email writer over HTTP.")
+    parser.add_argument("model_path")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", help="Listen on this Unix socket instead of host:port")
+    parser.add_argument("--reload-interval", type=float, default=2.0, help="Seconds between checks for a changed model file")
+    parser.add_argument("--max-models", type=int, default=4, help="Per-bucket models kept loaded at once")
+    args = parser.parse_args()
+
+    EmailRequestHandler.compiled = CompiledModel(args.model_path, args.reload_interval, args.max_models)
+    EmailRequestHandler.request_metrics = MetricsRegistry()
+    EmailRequestHandler.compiled.watch()
+
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+        server = UnixHTTPServer(args.unix_socket, EmailRequestHandler)
+        logger.info(f"Serving on unix socket {args.unix_socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), EmailRequestHandler)
+        server.daemon_threads = True
+        logger.info(f"Serving on http://{args.host}:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()